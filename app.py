@@ -15,26 +15,28 @@ from mars import webapp
 
 load_dotenv()
 
-# Allow different environments to test different functions
-if os.environ.get("ENVIRONMENT") == "PRODUCTION":
-    webapp.start_server()
-
-elif os.environ.get("ENVIRONMENT") == "DEV_WEB":
-    webapp.start_server()
-
-elif os.environ.get("ENVIRONMENT") == "DEV_COMMS":
-    from time import sleep
-
-    from mars.comms import commands
-    import threading
-    c = commands()
-    t = threading.Thread(target=c.start_comms)
-    t.start()
-    sleep(2)
-    c.move("engineer", 500, 1)
-    sleep(35)
-    c.move("engineer", 50, 0)
-    sleep(10)
-    c.stop("engineer")
-    sleep(10)
-    # c.start_comms()
+# Guarded so worker processes can import this module without starting the app
+if __name__ == "__main__":
+    # Allow different environments to test different functions
+    if os.environ.get("ENVIRONMENT") == "PRODUCTION":
+        webapp.start_server()
+
+    elif os.environ.get("ENVIRONMENT") == "DEV_WEB":
+        webapp.start_server()
+
+    elif os.environ.get("ENVIRONMENT") == "DEV_COMMS":
+        from time import sleep
+
+        from mars.comms import commands
+        import threading
+        c = commands()
+        t = threading.Thread(target=c.start_comms)
+        t.start()
+        sleep(2)
+        c.move("engineer", 500, 1)
+        sleep(35)
+        c.move("engineer", 50, 0)
+        sleep(10)
+        c.stop("engineer")
+        sleep(10)
+        # c.start_comms()
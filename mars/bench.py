@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+bench.py
+Benchmarks each stage of the vision system on recorded or synthetic marker frames.
+
+Run from the mech-2 folder:
+    $ python -m mars.bench --output bench_results.json
+    $ python -m mars.bench --recording run.rec
+
+Stages timed: decode, detect, pose, yaw, overlay, encode, and coords with --coords (saves marker positions to a private table).
+The results file records throughput, p50 / p95 / p99 latency and allocated bytes for each stage, so runs can be
+compared across commits and camera settings.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+
+import cv2
+from cv2 import aruco
+import numpy as np
+
+from mars import cam, logs, recorder, settings
+
+log = logs.create_log(__name__)
+
+STAGES = ["decode", "detect", "pose", "yaw", "overlay", "encode", "coords"]
+
+# Default benchmark scenes
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+MARKER_COUNTS = [1, 5, 10, 21, 50]
+
+
+def still_scenes(resolutions):
+    """
+    Scenes made from the marker photographs in cam_data, resized to each resolution.
+    """
+    scenes = []
+
+    for name in ["markers_1.png", "markers_2.png"]:
+        image = cv2.imread(os.path.join("mars", "cam_data", name))
+
+        if image is None:
+            log.warning(f"Unable to read still: {name}")
+            continue
+
+        for width, height in resolutions:
+            scenes.append({
+                "name": f"{name}@{width}x{height}",
+                "frames": [encode(cv2.resize(image, (width, height)))]
+            })
+
+    return scenes
+
+
+def synthetic_scenes(resolutions, counts, seed=0):
+    """
+    Scenes with `counts` markers laid out in a grid with random rotations, at each resolution.
+    """
+    rng = np.random.default_rng(seed)
+    aruco_dict = aruco.Dictionary_get(aruco.DICT_4X4_50)
+    scenes = []
+
+    for width, height in resolutions:
+        for count in counts:
+            image = np.full((height, width, 3), 180, dtype=np.uint8)
+
+            # Split the frame into a grid with one cell per marker
+            columns = int(np.ceil(np.sqrt(count * width / height)))
+            rows = int(np.ceil(count / columns))
+            cell = min(width // columns, height // rows)
+            size = int(cell / 1.6)
+
+            for index in range(count):
+                marker = aruco.drawMarker(aruco_dict, index % 50, size)
+                marker = cv2.copyMakeBorder(marker, size // 4, size // 4, size // 4, size // 4,
+                                            cv2.BORDER_CONSTANT, value=255)
+
+                # Rotate about the centre, filling the corners with the background
+                rotation = cv2.getRotationMatrix2D(
+                    (marker.shape[1] / 2, marker.shape[0] / 2), rng.uniform(0, 360), 1)
+                marker = cv2.warpAffine(marker, rotation, marker.shape[::-1],
+                                        borderValue=180)
+
+                row, column = divmod(index, columns)
+                y = row * cell + (cell - marker.shape[0]) // 2
+                x = column * cell + (cell - marker.shape[1]) // 2
+
+                # Markers may be clipped by the frame edge at awkward aspect ratios
+                patch = image[max(y, 0):y + marker.shape[0],
+                              max(x, 0):x + marker.shape[1]]
+                patch[:] = marker[:patch.shape[0], :patch.shape[1], None]
+
+            # Add sensor noise
+            noise = rng.normal(0, 4, image.shape)
+            image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+            scenes.append({
+                "name": f"synthetic_{count}@{width}x{height}",
+                "frames": [encode(image)]
+            })
+
+    return scenes
+
+
+def recording_scene(path):
+    """
+    Scene made from every frame of a recording.
+    """
+    rec = recorder.recording(path)
+    frames = [rec.frame(number)[1] for number in range(len(rec))]
+    rec.close()
+
+    return {"name": os.path.basename(path), "frames": frames}
+
+
+def encode(image):
+    _, encoded = cv2.imencode(".jpg", image)
+    return encoded.tobytes()
+
+
+class bench:
+    """
+    Runs frames through every stage of the vision system, recording timings and allocations.
+    """
+
+    def __init__(self, use_coords=False):
+        self.camera = cam.camera()
+        self.camera.setup_detection()
+
+        self.coords = None
+
+        if use_coords:
+            from mars import coords, markers
+
+            # Synthetic markers include the robots, so they are kept out of the shared table and Redis
+            markers.use_table(f"{settings.MARKER_TABLE_NAME}_bench_{os.getpid()}")
+            settings.MARKER_REDIS_MIRROR = False
+
+            self.coords = coords.coords()
+
+    def run_frame(self, jpeg, measure):
+        """
+        Run a single frame through all stages.
+        `measure(stage, func, *args)` is called to run and record each stage.
+        """
+        c = self.camera
+        frame = {"seq": 0, "time": time.time(), "jpeg": jpeg, "image": None}
+
+        if settings.DETECTION_SCALE > 1:
+            # Decodes straight to reduced grayscale, as the app does, so there is no separate decode stage
+            corners, ids = measure("detect", c.locate_reduced, frame)
+        else:
+            image = measure("decode", c.image, frame)
+            corners, ids = measure("detect", c.locate, image)
+
+        frame["corners"] = corners
+        frame["ids"] = ids
+        frame["rvecs"] = None
+
+        if ids is None:
+            out = measure("overlay", c.render, frame)
+            measure("encode", cv2.imencode, ".jpg", out)
+            return 0
+
+        if settings.DETECTION_MODE == "floor":
+            if c.floor.homography is None:
+                c.floor.calibrate(corners, ids)
+
+            # Floor mode cannot run until a fixed marker has been seen
+            if c.floor.homography is None:
+                return len(ids)
+
+            positions, yaws = measure("pose", c.floor.transform, corners)
+            tvecs = np.insert(positions, 2, 0, axis=1)[:, None]
+
+        else:
+            rvecs, tvecs, _ = measure("pose", aruco.estimatePoseSingleMarkers,
+                                      corners, 7, c.CM, c.dist_coef)
+            yaws = measure("yaw", cam.rvecs_to_yaw, rvecs)
+
+            frame["rvecs"] = rvecs
+            frame["tvecs"] = tvecs
+
+        out = measure("overlay", c.render, frame)
+
+        measure("encode", cv2.imencode, ".jpg", out)
+
+        if self.coords is not None:
+            measure("coords", self.coords.update_batch, ids, tvecs, yaws)
+
+        return len(ids)
+
+    def run_scene(self, scene, frames, alloc_frames, warmup=5):
+        """
+        Benchmark a scene, returning its results.
+        """
+        self.camera.tracked = {}
+        self.camera.frames_since_scan = 0
+        self.camera.floor.homography = None
+
+        timings = {stage: [] for stage in STAGES}
+        allocations = {stage: [] for stage in STAGES}
+        detected = []
+
+        def untimed(stage, func, *args):
+            return func(*args)
+
+        def timed(stage, func, *args):
+            start = time.perf_counter()
+            result = func(*args)
+            timings[stage].append(time.perf_counter() - start)
+            return result
+
+        def traced(stage, func, *args):
+            # reset_peak was added in Python 3.9; clearing the traces also resets the peak
+            if hasattr(tracemalloc, "reset_peak"):
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.clear_traces()
+                before = 0
+
+            result = func(*args)
+            allocations[stage].append(
+                tracemalloc.get_traced_memory()[1] - before)
+            return result
+
+        jpegs = scene["frames"]
+
+        for number in range(warmup):
+            self.run_frame(jpegs[number % len(jpegs)], untimed)
+
+        start = time.perf_counter()
+
+        for number in range(frames):
+            detected.append(self.run_frame(
+                jpegs[number % len(jpegs)], timed))
+
+        elapsed = time.perf_counter() - start
+
+        # Allocations are traced separately as tracing slows every stage
+        tracemalloc.start()
+
+        for number in range(alloc_frames):
+            self.run_frame(jpegs[number % len(jpegs)], traced)
+
+        tracemalloc.stop()
+
+        results = {
+            "frames": frames,
+            "markers": int(np.median(detected)) if detected else 0,
+            "fps": round(frames / elapsed, 2),
+            "stages": {}
+        }
+
+        for stage in STAGES:
+            if not timings[stage]:
+                continue
+
+            ms = np.array(timings[stage]) * 1000
+
+            results["stages"][stage] = {
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                "alloc_bytes": int(np.mean(allocations[stage])) if allocations[stage] else None
+            }
+
+        return results
+
+
+def commit():
+    """
+    Returns the current git commit, if available.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vision system")
+    parser.add_argument("--recording", action="append", default=[],
+                        help="Recording file to benchmark, may be repeated")
+    parser.add_argument("--no-synthetic", action="store_true",
+                        help="Skip the still and synthetic scenes")
+    parser.add_argument("--frames", type=int, default=100,
+                        help="Timed frames per scene")
+    parser.add_argument("--alloc-frames", type=int, default=10,
+                        help="Frames per scene traced for allocations")
+    parser.add_argument("--coords", action="store_true",
+                        help="Also time saving marker positions, to a private marker table")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="Machine-readable results file")
+    args = parser.parse_args()
+
+    scenes = [recording_scene(path) for path in args.recording]
+
+    if not args.no_synthetic:
+        scenes += still_scenes(RESOLUTIONS)
+        scenes += synthetic_scenes(RESOLUTIONS, MARKER_COUNTS)
+
+    b = bench(use_coords=args.coords)
+
+    results = {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "opencv": cv2.__version__,
+        "settings": {
+            "DETECTION_MODE": settings.DETECTION_MODE,
+            "DETECTION_SCALE": settings.DETECTION_SCALE,
+            "TRACKING": settings.TRACKING,
+            "TRACKING_SCAN_INTERVAL": settings.TRACKING_SCAN_INTERVAL
+        },
+        "scenes": {}
+    }
+
+    for scene in scenes:
+        result = b.run_scene(scene, args.frames, args.alloc_frames)
+        results["scenes"][scene["name"]] = result
+
+        summary = " | ".join(
+            f"{stage} {r['p50_ms']:.2f}/{r['p95_ms']:.2f}/{r['p99_ms']:.2f}"
+            for stage, r in result["stages"].items())
+
+        print(f"{scene['name']:<28} {result['markers']:>3} markers {result['fps']:>8.1f} FPS | "
+              f"p50/p95/p99 ms: {summary}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print(f"Results saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+broadcast.py
+Shares the annotated camera feed with any number of MJPEG viewers, drawing and encoding each frame only once.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import threading
+import time
+
+import cv2
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+# Empty part sent while no frame has been encoded yet
+KEEPALIVE = b'--frame\r\n' b'Content-Type: text/plain\r\n\r\n' b'\r\n'
+
+
+class hub:
+    """
+    Holds the latest detection results along with a frame sequence number.
+    Frames are drawn by `render(frame)` and JPEG encoded the first time a viewer
+    asks for them, and the same bytes are then sent to every other viewer.
+    """
+
+    def __init__(self, render):
+        self.render = render
+
+        self.condition = threading.Condition()
+        self.encode_lock = threading.Lock()
+
+        # Latest frame and its sequence number
+        self.frame = None
+        self.seq = 0
+
+        # Latest encoded frame and the sequence number it was encoded from
+        self.jpeg = None
+        self.jpeg_seq = 0
+
+        self.subscribers = 0
+
+    def publish(self, frame):
+        """
+        Store a new frame and wake any waiting viewers.
+        """
+        with self.condition:
+            self.frame = frame
+            self.seq += 1
+            self.condition.notify_all()
+
+    def encoded(self):
+        """
+        Returns the latest frame in multipart JPEG format along with its sequence number.
+        Only draws and encodes if the frame has changed since it was last encoded.
+        """
+        with self.encode_lock:
+            with self.condition:
+                frame = self.frame
+                seq = self.seq
+
+            if seq != self.jpeg_seq:
+                image = self.render(frame)
+
+                # Encode image in .jpg format
+                if image is None:
+                    flag = False
+                else:
+                    (flag, encodedImage) = cv2.imencode(".jpg", image)
+
+                # Ensure the frame was successfully encoded
+                if not flag:
+                    log.warning(f"Unable to encode frame: {seq}")
+                    return None, seq
+
+                self.jpeg = (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' +
+                             encodedImage.tobytes() + b'\r\n')
+                self.jpeg_seq = seq
+
+            return self.jpeg, self.jpeg_seq
+
+    def subscribe(self):
+        """
+        Yields each new frame to produce a live stream, until the viewer disconnects.
+        Frames are sent at most at the viewer framerate.
+        """
+        last_seq = 0
+
+        with self.condition:
+            self.subscribers += 1
+
+        try:
+            while True:
+                # Save start time to synchronise framerate
+                start_time = time.time()
+
+                # Wait for a frame which has not been sent yet
+                with self.condition:
+                    waiting = not self.condition.wait_for(lambda: self.seq != last_seq,
+                                                          settings.PIPELINE_TIMEOUT)
+
+                # Send something even when no frames arrive, otherwise a viewer which
+                # has disconnected is never noticed and is never removed
+                if waiting:
+                    yield self.jpeg if self.jpeg is not None else KEEPALIVE
+                    continue
+
+                jpeg, last_seq = self.encoded()
+
+                if jpeg is not None:
+                    yield jpeg
+
+                # Wait until the next frame is required
+                end_time = time.time()
+                time_remain = start_time + 1 / settings.VIEWER_FRAMERATE - end_time
+
+                if time_remain > 0:
+                    time.sleep(time_remain)
+
+        finally:
+            with self.condition:
+                self.subscribers -= 1
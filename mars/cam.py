@@ -7,44 +7,146 @@ Mechatronics 2
 ~ Callum Morrison, 2020
 """
 
-import math
+import functools
 import os
+import threading
 import time
 
 import cv2
 from cv2 import aruco
 import numpy as np
-import requests
 
-from mars import logs, settings
+from mars import broadcast, floor, logs, pipeline, recorder, settings, sources, trace, workers
 
 log = logs.create_log(__name__)
 
 
+# Decoding flags for each reduced detection scale
+REDUCED_GRAYSCALE = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+# Stop refining corners after 30 iterations or when moving less than 0.01 pixels
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS +
+                   cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+
+def rvecs_to_yaw(rvecs):
+    """
+    Converts an array of Rodriguez's angles, as returned by `aruco.estimatePoseSingleMarkers`,
+    to an array of yaws (Euler angles) for every marker at once.
+    """
+    rvecs = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3)
+
+    # Split each vector into a rotation angle and unit axis
+    theta = np.linalg.norm(rvecs, axis=1)
+    axis = rvecs / np.where(theta > 0, theta, 1)[:, None]
+    kx, ky, kz = axis.T
+
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+
+    # Required elements of the rotation matrix (Rodrigues' formula)
+    R00 = cos + (1 - cos) * kx * kx
+    R10 = (1 - cos) * kx * ky + sin * kz
+    R11 = cos + (1 - cos) * ky * ky
+    R12 = (1 - cos) * ky * kz - sin * kx
+
+    # Convert rotation matrix to yaw (Euler angles)
+    # Adapted from @kangaroo on stackoverflow.com
+    cosine_for_pitch = np.sqrt(R00 ** 2 + R10 ** 2)
+
+    is_singular = cosine_for_pitch < 10**-6
+
+    return np.where(is_singular, np.arctan2(-R12, R11), np.arctan2(R10, R00))
+
+
+def merge_regions(regions):
+    """
+    Merges overlapping [x0, y0, x1, y1] regions into their bounding boxes, until none overlap.
+    """
+    regions = [list(region) for region in regions]
+    merged = True
+
+    while merged:
+        merged = False
+
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                  max(a[2], b[2]), max(a[3], b[3])]
+                    del regions[j]
+                    merged = True
+                    break
+
+            if merged:
+                break
+
+    return regions
+
+
 class camera:
     """
     Class for all interactions with the video feed, image adjustments and recognition, aruco code identification, etc.
     """
 
-    def __init__(self):
-        self.out = ""
-        self.allow_stream = False
-        self.allow_generate = False
+    def __init__(self, number=0, governor=None):
+        # Position of this camera in the list of camera sources
+        self.number = number
+
+        # Optionally adapts the framerate to what the robots are doing
+        self.governor = governor
+
+        # Shares annotated frames with all connected viewers, drawing overlays on demand
+        self.hub = broadcast.hub(self.render)
+
+        self.stages = []
+        self.workers = []
+        self.source = None
+        self.recorder = None
 
     def setup(self):
         """
         Used to initialise variables and create camera objects.
         """
-        from mars import coords
-        self.coords = coords.coords()
+        urls = sources.env_list("CAM_IP")
+        self.url = urls[self.number] if self.number < len(urls) else None
+
+        log.info(f"Using camera {self.number} url: {self.url}")
+
+        # Open a persistent connection to the camera
+        self.source = sources.create_source(self.url, self.number)
 
-        self.url = os.environ.get("CAM_IP")
+        # Optionally record every raw frame to file
+        recordings = sources.env_list("CAM_RECORD")
 
-        log.info(f"Using camera url: {self.url}")
+        if self.number < len(recordings):
+            self.recorder = recorder.recorder(recordings[self.number])
+        else:
+            self.recorder = None
+
+        # Each camera may have its own calibration file
+        calibrations = sources.env_list("CAM_CALIBRATION")
+
+        if self.number < len(calibrations):
+            self.setup_detection(calibrations[self.number])
+        else:
+            self.setup_detection()
+
+    def setup_detection(self, calibration="Calibration.npz"):
+        """
+        Used to initialise the calibration and detection state, without connecting to a camera.
+        """
+        self.calibration = calibration
 
         # Read and store calibration information
         Camera = np.load(os.path.join(
-            "mars", "cam_data", "Calibration.npz"))
+            "mars", "cam_data", calibration))
         self.CM = Camera['CM']
 
         # Distortion coefficients from the camera
@@ -53,104 +155,405 @@ class camera:
         # Load the ArUco Dictionary Dictionary 4x4_50 and set the detection parameters
         self.aruco_dict = aruco.Dictionary_get(aruco.DICT_4X4_50)
 
-    def generate(self):
+        # Maps marker corners onto the compound floor
+        self.floor = floor.floor_plane(self.CM, self.dist_coef)
+
+        # Last known corners of each tracked marker, by aruco id
+        self.tracked = {}
+
+        # Frames since the last full frame scan
+        self.frames_since_scan = 0
+
+    def start(self, running, sink):
         """
-        Continuously reads the camera feed, and identifies aruco codes if required.
+        Starts reading the camera feed and identifying aruco codes while `running()` is True.
+        Capture and detection run as separate stages, handing the newest frame between them through
+        a bounded ring buffer. Detected frames are written to `sink`.
         """
 
+        # Disconnect from the camera if it was started before
+        self.stop()
+
         # Perform camera setup if not already complete
         self.setup()
 
-        while self.allow_generate:
-            # Save start time to synchronise framerate
-            start_time = time.time()
+        self.frame_count = 0
+
+        # Time the last frame was passed on to detection
+        self.emit_time = 0
+
+        captured = pipeline.ring_buffer("captured")
+
+        self.stages = [
+            pipeline.stage(f"capture_{self.number}", self.capture, sink=captured)
+        ]
+
+        if settings.DETECTION_WORKERS:
+            # One detection stage per worker process, each taking the newest frame in turn
+            self.workers = [workers.worker(self.number, self.calibration)
+                            for _ in range(settings.DETECTION_WORKERS)]
+
+            self.last_seq = 0
+            self.seq_lock = threading.Lock()
+
+            for index, w in enumerate(self.workers):
+                self.stages.append(pipeline.stage(
+                    f"detect_{self.number}_{index}", functools.partial(self.detect_remote, w),
+                    source=captured, sink=sink))
+
+        else:
+            self.workers = []
+
+            self.stages.append(pipeline.stage(
+                f"detect_{self.number}", self.detect, source=captured, sink=sink))
+
+        for s in self.stages:
+            s.start(running)
+
+    def stop(self):
+        """
+        Waits for the camera stages to finish, then disconnects from the camera.
+        Nothing is done if the camera is not running.
+        """
+        for s in self.stages:
+            s.join()
+
+        for w in self.workers:
+            w.close()
+
+        if self.source is not None:
+            self.source.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        self.stages = []
+        self.workers = []
+        self.source = None
+        self.recorder = None
 
-            # Toggle to allow connection to a USB camera
-            if os.environ.get("REAL_CAM"):
-                try:
-                    _, frame = cv2.VideoCapture(0).read()
-                except Exception as e:
-                    log.exception("Unable to connect to physical camera!")
-                    raise
+    def stats(self):
+        """
+        Returns the per-stage counters and queue depths of the vision pipeline.
+        """
+        return {s.name: s.stats() for s in self.stages}
+
+    def capture(self):
+        """
+        Capture stage; reads the latest frame from the camera, and passes frames on to detection at the target framerate.
+        """
+        # Save start time to synchronise framerate
+        start_time = time.time()
+
+        # Read latest frame from the camera, leaving JPEG frames undecoded until required
+        if hasattr(self.source, "read_raw"):
+            jpeg = self.source.read_raw()
+            image = None
+        else:
+            jpeg = None
+            image = self.source.read()
+
+        # Frames are stamped once they have arrived, so a slow read counts towards their age
+        capture_time = time.time()
+
+        if self.governor is not None:
+            framerate = self.governor.framerate()
+        else:
+            framerate = settings.FRAMERATE
+
+        # Wait until the next frame is required, unless the source sets its own pace
+        paced = getattr(self.source, "paced", False)
 
+        time_remain = start_time + 1 / framerate - capture_time
+
+        if time_remain > 0 and not paced:
+            time.sleep(time_remain)
+
+        # Skip dropped frames
+        if jpeg is None and image is None:
+            return
+
+        if self.recorder is not None:
+            if jpeg is None:
+                _, encoded = cv2.imencode(".jpg", image)
+                self.recorder.write(encoded.tobytes(), capture_time)
             else:
-                # Read latest frame from IP camera
-                try:
-                    resp = requests.get(self.url, stream=True).raw
-                except Exception as e:
-                    log.exception(
-                        "Unexpected error code when connecting to IP camera!")
-                    raise
+                self.recorder.write(jpeg, capture_time)
 
-                # Convert to openCV compatible image
-                frame = np.asarray(bytearray(resp.read()), dtype="uint8")
-                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+        # Paced sources are read at the camera framerate, but only passed on to detection at the target framerate
+        if paced and getattr(self.source, "realtime", True):
+            if capture_time < self.emit_time + 1 / framerate:
+                return
 
-            # Run the detection function
-            corners, ids, rP = aruco.detectMarkers(frame, self.aruco_dict)
+            self.emit_time = capture_time
 
-            # Draw the detected markers as an overlay on the original frame
-            self.out = aruco.drawDetectedMarkers(frame, corners, ids)
+        self.frame_count += 1
 
-            if ids is not None:
-                # Calculate the pose of the marker based on the Camera calibration
-                rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
-                    corners, 7, self.CM, self.dist_coef)
+        return {
+            "camera": self.number,
+            "seq": self.frame_count,
+            "time": capture_time,
+            "jpeg": jpeg,
+            "image": image
+        }
 
-                for index, _ in enumerate(ids):
-                    self.out = aruco.drawAxis(self.out, self.CM, self.dist_coef,
-                                              rvecs[index], tvecs[index], 10)
+    def image(self, frame):
+        """
+        Returns the full colour image for a frame, decoding it if required.
+        """
+        if frame["image"] is None:
+            frame["image"] = sources.decode(frame["jpeg"])
 
-                    # Convert Rodriguez's angles to rotation matrix
-                    R = cv2.Rodrigues(rvecs[index][0])[0]
+        return frame["image"]
 
-                    # Convert rotation matrix to yaw (Euler angles)
-                    # Adapted from @kangaroo on stackoverflow.com
-                    cosine_for_pitch = math.sqrt(R[0][0] ** 2 + R[1][0] ** 2)
+    def detect(self, frame):
+        """
+        Detection stage; finds aruco codes in a frame and estimates their pose.
+        """
+        # Run the detection function
+        if settings.DETECTION_SCALE > 1:
+            corners, ids = self.locate_reduced(frame)
+        else:
+            image = self.image(frame)
 
-                    is_singular = cosine_for_pitch < 10**-6
-                    if not is_singular:
-                        yaw = math.atan2(R[1][0], R[0][0])
-                    else:
-                        yaw = math.atan2(-R[1][2], R[1][1])
+            # Skip corrupt frames
+            if image is None:
+                return
 
-                    self.coords.update(ids[index], tvecs[index], yaw)
+            corners, ids = self.locate(image)
 
-            # Wait until the next frame is required
-            end_time = time.time()
-            time_remain = start_time + 1 / settings.FRAMERATE - end_time
+        # Keep the results so overlays can be drawn later if required
+        frame["corners"] = corners
+        frame["ids"] = ids
+        frame["rvecs"] = None
 
-            if time_remain > 0:
-                time.sleep(time_remain)
+        if ids is None:
+            pass
 
-    def video_feed(self):
+        elif settings.DETECTION_MODE == "floor":
+            # Calibrate the floor from the fixed compound markers once
+            if self.floor.homography is None and \
+                    not self.floor.calibrate(corners, ids):
+                frame["ids"] = None
+
+            else:
+                positions, yaws = self.floor.transform(corners)
+
+                # Store in the same format as pose estimation, on the floor plane
+                frame["tvecs"] = np.insert(positions, 2, 0, axis=1)[:, None]
+                frame["yaws"] = yaws
+
+        else:
+            # Calculate the pose of the marker based on the Camera calibration
+            rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
+                corners, 7, self.CM, self.dist_coef)
+
+            frame["rvecs"] = rvecs
+            frame["tvecs"] = tvecs
+            frame["yaws"] = rvecs_to_yaw(rvecs)
+
+        trace.span("detect", frame["time"])
+
+        # Only share frames if someone is watching
+        if self.hub.subscribers:
+            self.hub.publish(frame)
+
+        return frame
+
+    def detect_remote(self, worker, frame):
         """
-        Reads updated video feed and yields each frame to produce a live stream.
+        Detection stage run in a worker process; equivalent to `detect`.
+        Frames which finish after a newer frame are dropped.
         """
+        results = worker.detect(frame)
 
-        # Check that video has been started
-        if self.out == "":
+        if results is None:
             return
 
-        # Loop until a new session is created
-        while self.allow_stream:
-            # Save start time to synchronise framerate
-            start_time = time.time()
+        frame.update(results)
+
+        with self.seq_lock:
+            if frame["seq"] < self.last_seq:
+                return
+
+            self.last_seq = frame["seq"]
+
+        trace.span("detect", frame["time"])
+
+        # Only share frames if someone is watching
+        if self.hub.subscribers:
+            self.hub.publish(frame)
+
+        return frame
+
+    def render(self, frame):
+        """
+        Draws the detection results for a frame as an overlay on the original image.
+        """
+        image = self.image(frame)
+
+        # Frame was corrupt
+        if image is None:
+            return None
+
+        # Draw the detected markers as an overlay on the original frame
+        out = aruco.drawDetectedMarkers(image, frame["corners"], frame["ids"])
+
+        if frame["ids"] is not None and frame["rvecs"] is not None:
+            for index, _ in enumerate(frame["ids"]):
+                out = aruco.drawAxis(out, self.CM, self.dist_coef,
+                                     frame["rvecs"][index], frame["tvecs"][index], 10)
+
+        return out
+
+    def locate_reduced(self, frame):
+        """
+        Finds aruco codes in a reduced resolution grayscale copy of a frame, then refines
+        the corners of each detected marker at full resolution.
+
+        @returns:
+        corners, ids - In the same format as `aruco.detectMarkers`, in full resolution coordinates
+        """
+        scale = settings.DETECTION_SCALE
+
+        if frame["jpeg"] is not None:
+            # Decode straight to reduced grayscale
+            small = sources.decode(frame["jpeg"], REDUCED_GRAYSCALE[scale])
+        else:
+            small = cv2.cvtColor(frame["image"], cv2.COLOR_BGR2GRAY)
+            small = cv2.resize(small, None, fx=1 / scale, fy=1 / scale,
+                               interpolation=cv2.INTER_AREA)
+
+        # Skip corrupt frames
+        if small is None:
+            return (), None
+
+        corners, ids = self.locate(small)
+
+        if ids is None:
+            return corners, ids
+
+        # Full resolution grayscale image used to refine the corners
+        if frame["image"] is None:
+            full = sources.decode(frame["jpeg"], cv2.IMREAD_GRAYSCALE)
+        else:
+            full = frame["image"]
+
+        height, width = full.shape[:2]
+        window = settings.SUBPIX_WINDOW
+
+        refined = []
 
-            # Encode image in .jpg format
-            (flag, encodedImage) = cv2.imencode(".jpg", self.out)
+        for marker_corners in corners:
+            # Scale back to the centre of the matching full resolution pixels
+            marker_corners = marker_corners * scale + (scale - 1) / 2
 
-            # Ensure the frame was successfully encoded
-            if not flag:
+            # Only refine the region around the marker
+            low = np.maximum(marker_corners[0].min(axis=0).astype(int) - 2 * window, 0)
+            high = np.minimum(marker_corners[0].max(axis=0).astype(int) + 2 * window + 1,
+                              [width, height])
+
+            region = full[low[1]:high[1], low[0]:high[0]]
+
+            if region.ndim == 3:
+                region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+
+            points = (marker_corners[0] - low).astype(np.float32)
+
+            cv2.cornerSubPix(region, points, (window, window), (-1, -1),
+                             SUBPIX_CRITERIA)
+
+            refined.append((points + low).reshape(1, 4, 2).astype(np.float32))
+
+        return tuple(refined), ids
+
+    def locate(self, image):
+        """
+        Finds aruco codes in an image.
+        When tracking is enabled, only small regions around the last known corners of each
+        marker are searched. The full frame is scanned every `TRACKING_SCAN_INTERVAL` frames,
+        or whenever a tracked marker is lost.
+
+        @returns:
+        corners, ids - In the same format as `aruco.detectMarkers`
+        """
+        if settings.TRACKING and self.tracked and \
+                self.frames_since_scan < settings.TRACKING_SCAN_INTERVAL:
+
+            corners, ids = self.locate_tracked(image)
+
+            if ids is not None:
+                self.frames_since_scan += 1
+                return corners, ids
+
+        # Scan the full frame
+        corners, ids, _ = aruco.detectMarkers(image, self.aruco_dict)
+
+        self.frames_since_scan = 0
+        self.tracked = {}
+
+        if ids is not None:
+            for index, marker_id in enumerate(ids):
+                self.tracked[int(marker_id[0])] = corners[index][0]
+
+        return corners, ids
+
+    def locate_tracked(self, image):
+        """
+        Searches regions of interest around the tracked markers.
+        Overlapping regions are merged, so each pixel is searched at most once.
+
+        @returns:
+        corners, ids - In the same format as `aruco.detectMarkers`, or `None, None` if any marker was lost
+        """
+        height, width = image.shape[:2]
+
+        # Convert once rather than in every region
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # Pad each marker bounding box by a fraction of its size, as [x0, y0, x1, y1]
+        regions = []
+
+        for last_corners in self.tracked.values():
+            low = last_corners.min(axis=0)
+            high = last_corners.max(axis=0)
+            margin = max((high - low).max() * settings.TRACKING_MARGIN,
+                         settings.TRACKING_MIN_MARGIN)
+
+            regions.append([max(int(low[0] - margin), 0), max(int(low[1] - margin), 0),
+                            min(int(high[0] + margin) + 1, width), min(int(high[1] + margin) + 1, height)])
+
+        regions = merge_regions(regions)
+
+        # Markers which are not tracked may appear in a region, only keep the tracked ones
+        found = {}
+
+        for x0, y0, x1, y1 in regions:
+            corners, ids, _ = aruco.detectMarkers(
+                image[y0:y1, x0:x1], self.aruco_dict)
+
+            if ids is None:
                 continue
 
-            # Yield the output frame byte format
-            yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' +
-                  bytearray(encodedImage) + b'\r\n')
+            for marker_corners, marker_id in zip(corners, ids[:, 0].tolist()):
+                if marker_id in self.tracked and marker_id not in found:
+                    # Shift corners back into full frame coordinates
+                    found[marker_id] = marker_corners + \
+                        np.array([x0, y0], dtype=np.float32)
+
+        # Marker lost, fall back to a full frame scan
+        if len(found) < len(self.tracked):
+            return None, None
 
-            # Wait until the next frame is required
-            end_time = time.time()
-            time_remain = start_time + 1 / settings.FRAMERATE - end_time
+        for marker_id, marker_corners in found.items():
+            self.tracked[marker_id] = marker_corners[0]
 
-            if time_remain > 0:
-                time.sleep(time_remain)
+        return tuple(found.values()), np.array([[marker_id] for marker_id in found], dtype=np.int32)
+
+    def video_feed(self):
+        """
+        Yields each new annotated frame to produce a live stream.
+        Any number of viewers may be connected at once.
+        """
+        return self.hub.subscribe()
@@ -12,7 +12,7 @@ import time  # This is the library that will allow us to use the sleep function
 import paho.mqtt.client as mqtt  # This is the library to do the MQTT communications
 import redis
 
-from mars import logs, settings
+from mars import logs, settings, trace
 
 # Initialise the logs class for debugging and data logging
 log = logs.create_log(__name__)
@@ -257,9 +257,10 @@ class communications:
 
         self.client.publish(MainTopic, str(cmd))
 
-    def execute(self, device, instruction, payload):
+    def execute(self, device, instruction, payload, capture_time=None):
         """
         Publish commands to the mqtt server
+        `capture_time` is the capture time of the marker positions the command is based on, for latency tracing.
         """
 
         # Select channel to which to send the payload, instruction must match the data channels defined
@@ -268,6 +269,9 @@ class communications:
         # Publish to the MQTT server
         self.client.publish(ch, payload)
 
+        # Record the age of the marker positions this command was based on
+        trace.span("publish", capture_time)
+
         # Log the data published for debugging
         log.debug("Data published = " + payload + " On channel: " + ch)
 
@@ -406,19 +410,22 @@ class commands:
         self.comms = communications()
         self.comms.start_sending_doors()
 
-    def move(self, device, distance, angle):
+    def move(self, device, distance, angle, capture_time=None):
         """
         Sends a move command to the selected device
         ```device``` is a string representing the the robot to communicate with
         ```distance``` is a positive integer with the distance (mm) to move
         ```angle``` is a signed float in radians with the relative angle to turn
+        ```capture_time``` is the capture time of the marker positions the command is based on
         """
 
         # Change the angle from radians to degrees and send the inverse negative angle
         angle = -int(math.degrees(angle))
 
         # multiply the distance by a calibration factor to get approximate distance in mm
-        distance = distance * settings.DIST_MULTIPLIER
+        # positions are already in mm when using the floor detection mode
+        if settings.DETECTION_MODE != "floor":
+            distance = distance * settings.DIST_MULTIPLIER
 
         if distance > settings.MAX_DISTANCE:
             distance = settings.MAX_DISTANCE
@@ -429,7 +436,7 @@ class commands:
         # combine angle and distance information in one message
         payload = self.merge_data(distance, angle)
 
-        self.comms.execute(device, "move", payload)
+        self.comms.execute(device, "move", payload, capture_time)
 
     def stop(self, device):
         """
@@ -437,6 +444,7 @@ class commands:
         ```device``` is a string representing the the robot to communicate with
         """
 
+        # Not traced; stops are often sent because the positions are too old to use
         payload = "0"
         self.comms.execute(device, "stop", payload)
 
@@ -448,9 +456,10 @@ class commands:
         """
         pass
 
-    def simple_alien_move(self, magnitude, direction):
+    def simple_alien_move(self, magnitude, direction, capture_time=None):
         """
         Simple communication for direct Python to C code for the Arduino.
+        `capture_time` is the capture time of the marker positions the command is based on, for latency tracing.
 
         Send commands:
         direction:
@@ -488,9 +497,13 @@ class commands:
             log.debug("Stop")
             self.comms.client.publish(MainTopic, str(0))
 
-    def simple_engineer_move(self, magnitude, direction):
+        # Record the age of the marker positions this command was based on
+        trace.span("publish", capture_time)
+
+    def simple_engineer_move(self, magnitude, direction, capture_time=None):
         """
         Simple communication for direct Python to C code for the Arduino.
+        `capture_time` is the capture time of the marker positions the command is based on, for latency tracing.
 
         Send commands:
         direction:
@@ -533,3 +546,6 @@ class commands:
         else:
             log.debug("Stop")
             self.comms.client.publish(MainTopic, str(0))
+
+        # Record the age of the marker positions this command was based on
+        trace.span("publish", capture_time)
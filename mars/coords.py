@@ -9,12 +9,13 @@ Mechatronics 2
 
 import json
 import math
+import threading
 import time
-from copy import deepcopy
 
+import numpy as np
 import redis
 
-from mars import logs, settings
+from mars import doors, history, logs, maps, markers, routing, settings, trace, tracker, world
 from mars.comms import commands
 from mars.logic import update_ui
 
@@ -24,9 +25,38 @@ r = redis.Redis(host='localhost', port=6379,
                 db=0, decode_responses=True)
 
 
+def scale_distance(distance):
+    """
+    Converts a distance in aruco units (as used in settings) into the units marker positions are stored in.
+    Positions are in millimetres when using "floor" detection mode.
+    """
+    if settings.DETECTION_MODE == "floor":
+        return distance * settings.DIST_MULTIPLIER
+
+    return distance
+
+
+def predict(rows, now):
+    """
+    Predicts the [x, y, yaw] of markers in the marker table forward to `now`, from their velocities.
+    Markers which have never been seen are NaN.
+    """
+    # Don't predict further than the marker can be tracked
+    dt = np.clip(now - rows["time"], 0, settings.TRACKER_STALE_TIME)
+
+    positions = np.stack([
+        rows["x"] + rows["vx"] * dt,
+        rows["y"] + rows["vy"] * dt,
+        tracker.wrap(rows["yaw"] + rows["yaw_rate"] * dt)], axis=1)
+
+    positions[rows["seq"] == 0] = np.nan
+
+    return positions
+
+
 class coords:
     def __init__(self):
-        num_markers = 21
+        num_markers = maps.load().markers
 
         # --- SQLite was replaced with Redis for greater performance
         # Initialise markers database
@@ -52,11 +82,7 @@ class coords:
         self.markers = [0] * num_markers
 
         # Corresponding aruco ids
-        self.ids = {
-            "engineer": 0,
-            "alien": 1,
-            "entrance": 2
-        }
+        self.ids = maps.load().entities
 
         # Initialise start time for datarate sync
         self.start_time = time.time()
@@ -65,41 +91,61 @@ class coords:
         """
         Save a new position matrix to an aruco code id
         """
-        index = int(index[0])
+        self.update_batch([index], [tvecs], [yaw])
+
+    def update_batch(self, ids, tvecs, yaws, capture_time=None):
+        """
+        Save new position matrices for all aruco code ids detected in a frame.
+        Positions are filtered by the marker tracker, then saved in the shared marker table, and mirrored to the database
+        in a single request if `MARKER_REDIS_MIRROR` is set.
+        `capture_time` is the time the frame was captured, saved with each marker for latency tracing.
+        """
+        ids = np.asarray(ids, dtype=int).reshape(-1)
+        tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+        yaws = np.asarray(yaws, dtype=np.float64).reshape(-1)
 
-        old_marker = self.get_pos(index)
+        # The camera may accidentally detect markers we're not using, discard
+        valid = ids < len(self.markers)
 
-        # Smooth changes in marker position
-        if old_marker:
-            x_pos = old_marker[0] * (1 - settings.MARKER_SMOOTHING) + \
-                tvecs[0][0] * settings.MARKER_SMOOTHING
-            y_pos = old_marker[1] * (1 - settings.MARKER_SMOOTHING) + \
-                tvecs[0][1] * settings.MARKER_SMOOTHING
-        else:
-            x_pos = tvecs[0][0]
-            y_pos = tvecs[0][1]
+        if not valid.all():
+            ids, tvecs, yaws = ids[valid], tvecs[valid], yaws[valid]
 
-        # Don't smooth if angle switches sign from previous (loop round 180 to -180)
-        try:
-            sign_change = (yaw < 0) != (old_marker[2] < 0)
-        except TypeError:
-            sign_change = True
+        if not len(ids):
+            return
 
-        if not sign_change:
-            yaw = old_marker[2] * (1 - settings.MARKER_SMOOTHING) + \
-                yaw * settings.MARKER_SMOOTHING
+        # Positions are timestamped when saved if the capture time is unknown
+        timestamp = time.time() if capture_time is None else capture_time
 
-        # Assign markers in format [x_pos, y_pos, yaw]
-        try:
+        # Filter the new positions and estimate the velocity of each marker
+        pos, velocities, yaws, yaw_rates, times = tracker.get_tracker().update(
+            ids, tvecs[:, :2], yaws, timestamp)
+
+        table = markers.get_table()
+        table.write(ids, pos[:, 0], pos[:, 1], yaws,
+                    velocities[:, 0], velocities[:, 1], yaw_rates, times)
+
+        history.get_history().append(ids, pos[:, 0], pos[:, 1], yaws, times)
+
+        # Distances and directions between all markers for this frame, predicted to now
+        # Matrices only cover markers which are being tracked, as the map may have thousands of markers
+        now = time.time()
+        rows = table.read_many(range(len(self.markers)))
+        active = (rows["seq"] > 0) & (now - rows["time"] <= settings.TRACKER_STALE_TIME)
+
+        world.publish(predict(rows, now), now, rows["time"], active)
+
+        for index, (x_pos, y_pos), yaw in zip(ids.tolist(), pos.tolist(), yaws.tolist()):
+            # Assign markers in format [x_pos, y_pos, yaw]
             self.markers[index] = [
                 round(x_pos, 4),
                 round(y_pos, 4),
                 round(yaw, 4)]
-        except IndexError:
-            # The camera has accidentally detected a marker we're not using, discard
-            return
 
-        r.set(index, json.dumps([x_pos, y_pos, yaw]))
+        # Copy positions to the database for anything outside this system which still reads them
+        if settings.MARKER_REDIS_MIRROR:
+            markers.get_mirror().write(ids, rows[ids])
+
+        trace.span("update", capture_time)
 
         # Only send updated marker positions at required polling interval
         end_time = time.time()
@@ -113,7 +159,8 @@ class coords:
 
     def get_pos(self, entity):
         """
-        Get the current position of an aruco marker
+        Get the current position of an aruco marker, in format [x_pos, y_pos, yaw, capture_time]
+        Positions are predicted forward to now from the velocity of the marker, to make up for camera and processing latency.
         """
         try:
             # Valid for aruco code ids or entity names
@@ -122,18 +169,79 @@ class coords:
             else:
                 index = self.ids[entity]
 
-            try:
-                marker = json.loads(r.get(index))
-            except TypeError:
+            marker = markers.get_table().read(index)
+
+            if marker is None:
                 log.warning(f"Invalid marker position for index: {index}!")
                 return [-999, -999, -999]
 
-            return marker
+            # Don't predict further than the marker can be tracked
+            dt = min(max(time.time() - marker["time"], 0),
+                     settings.TRACKER_STALE_TIME)
+
+            x_pos = marker["x"] + marker["vx"] * dt
+            y_pos = marker["y"] + marker["vy"] * dt
+            yaw = tracker.wrap(marker["yaw"] + marker["yaw_rate"] * dt)
+
+            return [float(x_pos), float(y_pos), float(yaw), float(marker["time"])]
 
         except Exception as e:
             log.exception(e)
             return False
 
+    def is_stale(self, entity):
+        """
+        Check if an aruco marker has not been seen recently enough to be steered by.
+        """
+        index = entity if isinstance(entity, int) else self.ids[entity]
+        marker = markers.get_table().read(index)
+
+        return marker is None or time.time() - marker["time"] > settings.TRACKER_STALE_TIME
+
+    def vector(self, source, target):
+        """
+        Returns the distance and direction between two aruco markers, as `calculate_vector`,
+        read from the snapshot of all markers made for the latest frame.
+        """
+        snapshot = world.latest()
+
+        if snapshot is None:
+            return self.calculate_vector(source, target)
+
+        # Valid for aruco code ids or entity names
+        source = source if isinstance(source, int) else self.ids[source]
+        target = target if isinstance(target, int) else self.ids[target]
+
+        vector = snapshot.vector(source, target)
+
+        if vector is None:
+            log.error(
+                "Vector calculation between two points failed because one or both points did not exist!")
+            return
+
+        trace.span("vector", snapshot.capture_time(source, target))
+
+        return vector
+
+    def capture_time(self, source, target):
+        """
+        Returns the capture time of the oldest of the two positions a vector between two aruco markers is calculated from,
+        used to trace the latency of commands based on it. None if either marker has not been seen.
+        """
+        # Valid for aruco code ids or entity names
+        source = source if isinstance(source, int) else self.ids[source]
+        target = target if isinstance(target, int) else self.ids[target]
+
+        snapshot = world.latest()
+
+        if snapshot is not None:
+            capture_time = snapshot.capture_time(source, target)
+        else:
+            rows = markers.get_table().read_many([source, target])
+            capture_time = None if (rows["seq"] == 0).any() else float(rows["time"].min())
+
+        return capture_time
+
     def calculate_vector(self, source, target):
         """
         Calculates the vector between two aruco markers.
@@ -153,6 +261,13 @@ class coords:
                 "Vector calculation between two points failed because one or both points did not exist!")
             return
 
+        # Age of the vector is set by the oldest of the two positions
+        capture_times = [pos[3] for pos in [pos_source, pos_target]
+                         if len(pos) > 3 and pos[3] is not None]
+
+        if len(capture_times) == 2:
+            trace.span("vector", min(capture_times))
+
         # Calculate distance between markers
         magnitude = math.sqrt(
             (pos_target[0] - pos_source[0])**2 + (pos_target[1] - pos_source[1])**2)
@@ -188,7 +303,7 @@ class coords:
 
 class route:
     """
-    Storage of allowable paths that can be travelled.
+    Storage of allowable paths that can be travelled, loaded from the compound map file.
     Stored in a two-layer list of the following format:
 
         [
@@ -200,68 +315,37 @@ class route:
 
     """
 
+    # Route planner shared by every route object
+    _planner = None
+    planner_lock = threading.Lock()
+
     def __init__(self):
+        # Compound map, loaded from mars/maps
+        self.map = maps.load()
+
         # Routes allowed for the engineer
-        self.allowed_routes = [
-            [],                 # Reserved for engineer
-            [],                 # Reserved for alien
-            [4, 15],            # 2 - Launch Pad
-            [],                 # 3 - Unused
-            [2, 5],             # 4
-            [4, 6],             # 5
-            [5, 7],             # 6
-            [6, 8, 17],         # 7 - Door B
-            [7, 9, 18],         # 8 - Door A
-            [8, 10],            # 9 - Door A; Alien Start; Second Task
-            [9, 11],            # 10
-            [10, 12, 13],       # 11
-            [11, 13, 20],       # 12 - Third Task; Door D
-            [11, 12, 14, 19],   # 13 - Door C
-            [13, 15, 16],       # 14
-            [2, 14, 20],        # 15
-            [14, 17],           # 16
-            [7, 16],            # 17 - First Task; Door B
-            [8, 19],            # 18
-            [13, 18],           # 19 - Door C
-            [12, 15],           # 20 - Door D
-        ]
+        self.allowed_routes = self.map.routes
 
         # Markers which require a check for an open door
-        self.markers_doors = [
-            [7, 17],    # Door 0 / A
-            [8, 9],     # Door 1 / B
-            [19, 13],   # Door 2 / C
-            [20, 12]    # Door 3 / D
-        ]
+        self.markers_doors = self.map.doors
 
-        # Update shortcuts for alien
-        self.allowed_routes_alien = deepcopy(self.allowed_routes)
+        # Routes allowed for the alien, with shortcuts through the vents
+        self.allowed_routes_alien = self.map.routes_alien
 
-        vents = [
-            [4, 17],
-            [17, 18],
-            [18, 10],
-            [16, 2]
-        ]
-
-        for vent in vents:
-            self.allowed_routes_alien[vent[0]].append(vent[1])
-            self.allowed_routes_alien[vent[1]].append(vent[0])
+    def planner(self):
+        """
+        Returns the route tables for the compound, calculating them the first time they are needed.
+        """
+        with route.planner_lock:
+            if route._planner is None:
+                route._planner = routing.planner(
+                    self.map, scale_distance(settings.ROUTE_GEOMETRY_TOLERANCE))
 
-        # self.weights = [
-        #     0,  # Reserved for engineer
-        #     0,  # Reserved for alien
-        #     1,  # 2 - Front door
-        # ]
+            return route._planner
 
     def initialise_doors(self):
         # Current state of all doors, all open to start
-        r.set("doors_state", json.dumps([
-            True,       # Door 1 / A
-            True,       # Door 2 / B
-            True,       # Door 3 / C
-            True        # Door 4 / D
-        ]))
+        r.set("doors_state", json.dumps([True] * len(self.markers_doors)))
 
         update_ui()
 
@@ -274,143 +358,179 @@ class route:
         Opens or closes a door identified by `index`.
         `state` is True for open and False for closed.
         """
+        self.set_doors({index: state})
 
-        # If state is to close a door
-        if not state:
+    def set_doors(self, states):
+        """
+        Opens or closes several doors at once; `states` maps each door index to True for open and False for closed.
+        Doors which a robot is passing through are not closed.
+
+        @returns:
+        List of door indexes which were not closed
+        """
+        occupancy = doors.get_occupancy()
+
+        # Don't close a door on a robot
+        refused = [index for index, state in states.items()
+                   if not state and occupancy.blocked(index)]
+
+        doors_state = json.loads(r.get("doors_state"))
 
-            # Try Engineer route first
-            try:
-                # Read current route
-                engineer_target_route = json.loads(
-                    r.get("engineer_target_route") or "[]")
+        for index, state in states.items():
+            if index not in refused:
+                doors_state[index] = state
 
-                for door_index, door in enumerate(self.markers_doors):
+                log.info(f"Command: {state} send to door index: {index}")
 
-                    # If first point matches door
-                    if int(r.get("engineer_current_marker") or -1) in door:
+        if refused:
+            log.warning(f"Doors occupied, not closing: {refused}")
 
-                        # If second point is in same door direction
-                        if engineer_target_route[0] in door:
+        r.set("doors_state", json.dumps(doors_state))
 
-                            # If door index is the same as requested index
-                            if door_index == index:
+        update_ui()
 
-                                # Return, don't close door
-                                return
+        return refused
 
-            except IndexError:
-                # Route too short
-                pass
+    def positions(self, weighting=True):
+        """
+        Returns the [x, y] position of every marker for weighting routes by distance, or None if not required.
+        Markers which have never been seen are NaN.
+        Positions are always returned if `weighting` is False.
+        """
+        if weighting and settings.ROUTE_WEIGHTING != "distance":
+            return None
 
-            # Then try Alien route
-            try:
-                # Read current route
-                alien_target_route = json.loads(
-                    r.get("alien_target_route") or "[]")
+        rows = markers.get_table().read_many(range(len(self.allowed_routes)))
 
-                for door_index, door in enumerate(self.markers_doors):
+        positions = np.stack([rows["x"], rows["y"]], axis=1)
+        positions[rows["seq"] == 0] = np.nan
 
-                    # If first point matches door
-                    if int(r.get("alien_current_marker") or -1) in door:
+        return positions
 
-                        # If second point is in same door direction
-                        if alien_target_route[0] in door:
+    def session(self, shortcuts=False):
+        """
+        Returns an incremental route planner for one robot, which keeps its search between calls to `replan`.
+        `shortcuts` are True for Alien, and False for Engineer.
+        """
+        planner = self.planner()
+        positions = self.positions()
 
-                            # If door index is the same as requested index
-                            if door_index == index:
+        if positions is not None:
+            planner.update_positions(positions)
 
-                                # Return, don't close door
-                                return
+        return planner.session(shortcuts)
 
-            except IndexError:
-                # Route too short
-                pass
+    def replan(self, session, start, finish, avoid=None):
+        """
+        Repairs the route of a robot from `start` to `finish` using its incremental route planner,
+        after doors are opened or closed, or the marker to `avoid` changes.
 
+        @return:
+        `route`: A list of codes to travel through to the destination.
+        """
         doors_state = json.loads(r.get("doors_state"))
-        doors_state[index] = state
 
-        r.set("doors_state", json.dumps(doors_state))
+        blocked = self.planner().blocked(
+            start, doors_state, session.shortcuts, avoid)
 
-        log.info(f"Command: {state} send to door index: {index}")
+        best_route = session.route(start, finish, blocked)
 
-        update_ui()
+        if best_route:
+            return best_route
 
-    def pathfinder(self, start, finish, shortcuts=False, avoid=None):
+        # No route was found
+        log.error(f"No route found between {start} and {finish}")
+        return False
+
+    def spacetime(self, start, finish):
         """
-        Computes fastest path between two points, with an optional avoidance parameter.
-        Will not pass over the same point twice.
-        `start`, `finish`, and `avoid`, should all be aruco code integers.
-        `shortcuts` are True for Alien, and False for Engineer.
+        Plans the Engineer's route to keep clear of where the Alien will be, predicted from the
+        Alien's planned route and its speed.
 
         @return:
-        `route`: A list of codes to travel through to the destination.
+        `route`: A list of codes to travel through to the destination, or False if no route was found.
+        `depart`: Time to leave `start`, if it is better to wait for the Alien to pass.
         """
+        now = time.time()
 
-        # Initialise all routes
-        routes = []
-        routes_old = []
-        solution_found = False
+        doors_state = json.loads(r.get("doors_state"))
+        positions = self.positions(weighting=False)
 
-        # Adjust routes according to shortcuts
-        if shortcuts:
-            allowed_routes = deepcopy(self.allowed_routes_alien)
-        else:
-            allowed_routes = deepcopy(self.allowed_routes)
+        def distance(a, b):
+            return math.hypot(*(positions[a] - positions[b]))
 
-        # Check if doors are locked and adjust route if required
-        doors_state = json.loads(r.get("doors_state"))
-        for index in range(4):
+        def travel_time(a, b, speed):
+            # Markers which haven't been seen take a fixed time to reach
+            if np.isnan(positions[[a, b]]).any():
+                return settings.SPACETIME_HOP_TIME
+
+            return distance(a, b) / speed
+
+        def speed(entity, expected):
+            # Use the measured speed of the robot while moving, within reason
+            expected = scale_distance(expected)
+            measured = history.get_history().speed(
+                self.map.entities[entity], settings.SPACETIME_SPEED_WINDOW, expected / 4)
 
-            # Check if door is open
-            if doors_state[index]:
-                continue
+            if measured is None:
+                return expected
 
-            # Only adjust if start point next to a door
-            if start in self.markers_doors[index]:
+            return min(max(measured, expected / 4), expected * 4)
 
-                # Remove route through the door
-                for code in self.markers_doors[index]:
-                    allowed_routes[code] = [
-                        x for x in allowed_routes[code] if x not in self.markers_doors[index]]
+        engineer_speed = speed("engineer", settings.ENGINEER_SPEED)
+        alien_speed = speed("alien", settings.ALIEN_SPEED)
 
-        # Loop over all possible next positions from the starting position
-        for next_point in allowed_routes[start]:
-            if next_point != avoid:
-                routes.append(
-                    [start, next_point]
-                )
+        # Predict when the Alien will reach each marker in its route
+        alien_route = [int(r.get("alien_current_marker")),
+                       *json.loads(r.get("alien_target_route") or "[]")]
+        arrivals = [now]
 
-        # Keep looking while new routes are being generated
-        while routes and not solution_found:
-            routes_old = routes
-            routes = []
+        for a, b in zip(alien_route, alien_route[1:]):
+            arrivals.append(arrivals[-1] + travel_time(a, b, alien_speed))
 
-            # Loop over all current routes
-            for route in routes_old:
-                last_point = route[-1]
+        radius = scale_distance(settings.DETECTION_RADIUS)
 
-                # Append to routes if finish reached
-                if last_point == finish:
-                    routes.append(route)
-                    solution_found = True
-                    break
+        def nearby(code):
+            # Markers within hearing distance, or next to the marker if positions are unknown
+            if np.isnan(positions[code]).any():
+                return [code, *self.allowed_routes_alien[code]]
 
-                # Loop over possible routes from here
-                for next_point in allowed_routes[last_point]:
+            return [code, *np.flatnonzero(np.hypot(*(positions - positions[code]).T) < radius).tolist()]
 
-                    # Only update route if not already traversed through points
-                    if next_point not in [*route, avoid]:
+        reserved = routing.reservations(alien_route, arrivals, nearby,
+                                        settings.SPACETIME_MARGIN, now + settings.SPACETIME_HORIZON)
 
-                        # Add new route to existing routes
-                        routes.append([*route, next_point])
+        best_route, depart = routing.spacetime(
+            self.planner(), start, finish, doors_state, reserved,
+            lambda a, b: travel_time(a, b, engineer_speed), now)
 
-        # Remove routes which don't end at the finish
-        routes = [route for route in routes_old if route[-1] == finish]
+        if best_route:
+            return best_route, depart
+
+        log.warning(
+            f"No route found between {start} and {finish} which avoids the Alien")
+        return False, now
+
+    def pathfinder(self, start, finish, shortcuts=False, avoid=None):
+        """
+        Computes fastest path between two points, with an optional avoidance parameter.
+        Routes are weighted by the distance between markers when `ROUTE_WEIGHTING` is "distance" and
+        the markers have been seen, otherwise looked up from tables of the routes with the fewest markers.
+        Robots repairing the same route as they move should keep an incremental planner with `session` instead.
+        `start`, `finish`, and `avoid`, should all be aruco code integers.
+        `shortcuts` are True for Alien, and False for Engineer.
+
+        @return:
+        `route`: A list of codes to travel through to the destination.
+        """
+
+        # Check if doors are locked; closed doors only block the route from a marker next to the door
+        doors_state = json.loads(r.get("doors_state"))
 
-        # Rank remaining routes by length
-        if routes:
-            best_route = min(routes, key=len)
+        best_route = self.planner().route(
+            start, finish, doors_state, shortcuts, avoid, self.positions())
 
+        if best_route:
             return best_route
 
         # No route was found
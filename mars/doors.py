@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+doors.py
+Index of the doors each robot is passing through, so a request to close a door is answered without reading Redis.
+
+A robot is in a door when its current marker and the first marker of its route are the two sides
+of the door. The index is updated whenever a robot's current marker or route is saved with `move`.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import json
+import threading
+
+import redis
+
+from mars import logs, maps
+
+log = logs.create_log(__name__)
+
+r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+
+# Robots which can pass through doors
+AGENTS = ["engineer", "alien"]
+
+# Index shared by everything in this process
+_occupancy = None
+_occupancy_lock = threading.Lock()
+
+
+def get_occupancy():
+    """
+    Returns the door occupancy index for this process, creating it if needed.
+    """
+    global _occupancy
+
+    with _occupancy_lock:
+        if _occupancy is None:
+            _occupancy = occupancy(maps.load())
+
+        return _occupancy
+
+
+def move(agent, current=None, route=None):
+    """
+    Save the current marker and/or route of a robot, keeping the door occupancy index up to date.
+    """
+    if current is not None:
+        r.set(f"{agent}_current_marker", current)
+
+    if route is not None:
+        r.set(f"{agent}_target_route", str(route))
+
+    get_occupancy().update(agent, current, route)
+
+
+class occupancy:
+    """
+    Doors which each robot is currently passing through.
+    """
+
+    def __init__(self, compound_map):
+        # Doors between each pair of markers, in both directions
+        self.lookup = {}
+
+        for index, door in enumerate(compound_map.doors):
+            for a in door:
+                for b in door:
+                    self.lookup.setdefault((a, b), set()).add(index)
+
+        self.lock = threading.Lock()
+
+        # Current marker and next marker of each robot, starting from the values saved in Redis
+        self.steps = {}
+        self.occupied = {}
+
+        for agent in AGENTS:
+            current = r.get(f"{agent}_current_marker")
+            route = json.loads(r.get(f"{agent}_target_route") or "[]")
+
+            self.steps[agent] = [int(current) if current is not None else None,
+                                 route[0] if route else None]
+            self.occupied[agent] = self.lookup.get(tuple(self.steps[agent]), set())
+
+    def update(self, agent, current=None, route=None):
+        """
+        Update the doors a robot is in after its current marker or route changes.
+        """
+        with self.lock:
+            step = self.steps[agent]
+
+            if current is not None:
+                step[0] = int(current)
+
+            if route is not None:
+                step[1] = route[0] if route else None
+
+            self.occupied[agent] = self.lookup.get(tuple(step), set())
+
+    def blocked(self, index):
+        """
+        Returns True if a robot is passing through the door identified by `index`.
+        """
+        return any(index in doors for doors in self.occupied.values())
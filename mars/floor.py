@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+floor.py
+Maps marker corners in the camera image onto the compound floor, giving positions in millimetres.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import cv2
+import numpy as np
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+
+class floor_plane:
+    """
+    Camera to floor homography, calculated from the fixed compound markers listed in `settings.FLOOR_MARKERS`.
+
+    The floor axes follow the first fixed marker: x runs along its top edge, and y runs down its left edge,
+    matching the orientation of the camera image so angle conventions are unchanged.
+    """
+
+    def __init__(self, CM, dist_coef):
+        # Camera calibration, used to remove lens distortion before mapping to the floor
+        self.CM = CM
+        self.dist_coef = dist_coef
+
+        self.homography = None
+
+    def undistort(self, points):
+        """
+        Removes lens distortion from an array of image points, keeping pixel units.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+        return cv2.undistortPoints(points, self.CM, self.dist_coef, P=self.CM)
+
+    def calibrate(self, corners, ids):
+        """
+        Calculate the homography from any fixed compound markers visible in a frame.
+
+        @returns:
+        True if the floor has been calibrated
+        """
+        if ids is None:
+            return False
+
+        half = settings.FLOOR_MARKER_SIZE / 2
+
+        # Corner offsets from the marker centre, in aruco corner order
+        offsets = np.array([
+            [-half, -half],
+            [half, -half],
+            [half, half],
+            [-half, half]])
+
+        image_points = []
+        floor_points = []
+
+        for index, marker_id in enumerate(ids):
+            centre = settings.FLOOR_MARKERS.get(int(marker_id[0]))
+
+            if centre is None:
+                continue
+
+            image_points.append(corners[index].reshape(4, 2))
+            floor_points.append(offsets + centre)
+
+        # Fixed markers are not visible yet
+        if not image_points:
+            return False
+
+        image_points = self.undistort(np.concatenate(image_points))
+        floor_points = np.concatenate(floor_points).astype(np.float32)
+
+        self.homography, _ = cv2.findHomography(image_points, floor_points)
+
+        if self.homography is None:
+            log.warning("Unable to calculate floor homography")
+            return False
+
+        log.info(
+            f"Floor calibrated from {len(floor_points) // 4} fixed marker(s)")
+
+        return True
+
+    def transform(self, corners):
+        """
+        Maps all detected marker corners onto the floor in a single transform.
+
+        @returns:
+        positions - Array of marker centres [x, y] in millimetres
+        yaws - Array of marker headings in radians, measured along the top edge of each marker
+        """
+        points = self.undistort(np.concatenate(corners))
+        points = cv2.perspectiveTransform(points, self.homography)
+        points = points.reshape(-1, 4, 2)
+
+        positions = points.mean(axis=1)
+
+        # Heading from top-left to top-right corner
+        edge = points[:, 1] - points[:, 0]
+        yaws = np.arctan2(edge[:, 1], edge[:, 0])
+
+        return positions, yaws
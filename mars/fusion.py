@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+fusion.py
+Runs one or more cameras in parallel and fuses their marker estimates before saving them.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import threading
+
+import numpy as np
+
+from mars import cam, governor, logs, pipeline, settings, sources, trace
+
+log = logs.create_log(__name__)
+
+
+def marker_areas(corners):
+    """
+    Returns the area in pixels of each detected marker, used as the confidence of its estimate.
+    """
+    points = np.concatenate(corners).reshape(-1, 4, 2)
+    x, y = points[:, :, 0], points[:, :, 1]
+
+    # Shoelace formula
+    return 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1))
+
+
+class collector:
+    """
+    Keeps the latest detected frame from every camera.
+    Used as the sink for each camera and the source for the fusion stage, in place of a `pipeline.ring_buffer`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = {}
+        self.condition = threading.Condition()
+
+        # Set when a frame arrives which has not been fused yet
+        self.updated = False
+
+        # Counters for monitoring
+        self.pushed = 0
+        self.dropped = 0
+        self.stale = 0
+
+    def put(self, frame):
+        with self.condition:
+            # Previous frame from this camera was never fused
+            if frame["camera"] in self.frames and self.updated:
+                self.dropped += 1
+
+            self.frames[frame["camera"]] = frame
+            self.updated = True
+            self.pushed += 1
+
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Wait for a new frame from any camera, then return the latest frames from all cameras.
+        When fusing several cameras, frames much older than the newest are left out.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.updated, timeout):
+                return None
+
+            self.updated = False
+
+            frames = list(self.frames.values())
+
+        # A single camera's latest frame is always used, however long detection took
+        if len(frames) < 2:
+            return frames
+
+        oldest = max(frame["time"] for frame in frames) - settings.FUSION_MAX_AGE
+
+        fresh = [frame for frame in frames if frame["time"] > oldest]
+
+        if len(fresh) < len(frames):
+            self.stale += len(frames) - len(fresh)
+
+            log.debug("Frames too old to fuse from cameras: "
+                      f"{[frame['camera'] for frame in frames if frame['time'] <= oldest]}")
+
+        return fresh
+
+    def depth(self):
+        return int(self.updated)
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "pushed": self.pushed,
+            "dropped": self.dropped,
+            "stale": self.stale
+        }
+
+
+def fuse(frames):
+    """
+    Combines marker estimates from several cameras into one frame.
+    Each marker's position is the mean of every camera's estimate weighted by confidence (marker area),
+    and its yaw is the equivalent weighted circular mean.
+
+    @returns:
+    ids, tvecs, yaws - In the same format as a single camera frame, or `None, None, None` if no markers were detected
+    """
+    frames = [frame for frame in frames if frame["ids"] is not None]
+
+    if not frames:
+        return None, None, None
+
+    # Nothing to combine with a single camera
+    if len(frames) == 1:
+        return frames[0]["ids"], frames[0]["tvecs"], frames[0]["yaws"]
+
+    ids = np.concatenate([frame["ids"].reshape(-1) for frame in frames])
+    tvecs = np.concatenate([frame["tvecs"].reshape(-1, 3)
+                            for frame in frames])
+    yaws = np.concatenate([np.asarray(frame["yaws"]) for frame in frames])
+    weights = np.concatenate([marker_areas(frame["corners"])
+                              for frame in frames])
+
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    total = np.bincount(inverse, weights)
+
+    fused_tvecs = np.stack([
+        np.bincount(inverse, weights * tvecs[:, axis]) / total
+        for axis in range(3)], axis=1)
+
+    fused_yaws = np.arctan2(np.bincount(inverse, weights * np.sin(yaws)),
+                            np.bincount(inverse, weights * np.cos(yaws)))
+
+    return unique_ids[:, None], fused_tvecs[:, None], fused_yaws
+
+
+class rig:
+    """
+    All cameras listed in `CAM_IP` (or `CAM_DEVICE` / `CAM_REPLAY`), each processed in its own stages.
+    Marker estimates from every camera are fused before being saved through `coords`.
+    """
+
+    def __init__(self):
+        # Set to stop the running cameras, and set by `generate` once they have stopped
+        self.stopping = threading.Event()
+        self.stopped = threading.Event()
+        self.stopped.set()
+
+        # Only one `generate` may start or stop the cameras at a time
+        self.lock = threading.Lock()
+
+        self.cameras = []
+        self.stages = []
+
+        # Shared by all cameras to adapt the framerate to what the robots are doing
+        self.governor = governor.governor()
+
+    def setup(self):
+        """
+        Creates a camera object for every camera in the environment, if not already created.
+        """
+        if not self.cameras:
+            self.cameras = [cam.camera(number, self.governor)
+                            for number in range(sources.camera_count())]
+
+    def generate(self):
+        """
+        Continuously reads every camera feed, and identifies and fuses aruco codes, until `stop` is called.
+        Any cameras already running are stopped first.
+        """
+        with self.lock:
+            self.stop()
+
+            self.stopping.clear()
+            self.stopped.clear()
+
+        try:
+            self.run()
+        finally:
+            self.stopped.set()
+
+    def stop(self):
+        """
+        Stops the cameras, waiting until every stage has finished and the cameras are disconnected.
+        """
+        self.stopping.set()
+        self.stopped.wait()
+
+    def running(self):
+        return not self.stopping.is_set()
+
+    def run(self):
+        """
+        Runs the camera and fusion stages until stopped, then waits for them to finish.
+        """
+        self.setup()
+
+        from mars import coords
+        self.coords = coords.coords()
+
+        if len(self.cameras) > 1 and settings.DETECTION_MODE != "floor":
+            log.warning(
+                "Multiple cameras only share coordinates in floor detection mode!")
+
+        detected = collector("detected")
+
+        for camera in self.cameras:
+            camera.start(self.running, detected)
+
+        self.stages = [
+            pipeline.stage("publish", self.publish, source=detected)
+        ]
+
+        for s in self.stages:
+            s.start(self.running)
+
+        # Periodically report pipeline statistics while running
+        while not self.stopping.wait(settings.PIPELINE_STATS_INTERVAL):
+            log.debug(f"Vision pipeline: {self.stats()}")
+            log.debug(f"Latency: {trace.report()}")
+
+        for s in self.stages:
+            s.join()
+
+        for camera in self.cameras:
+            camera.stop()
+
+    def publish(self, frames):
+        """
+        Publish stage; fuses and saves the detected marker positions.
+        """
+        ids, tvecs, yaws = fuse(frames)
+
+        if ids is None:
+            return
+
+        # Fused positions are as old as the oldest frame used
+        capture_time = min(frame["time"] for frame in frames)
+
+        self.coords.update_batch(ids, tvecs, yaws, capture_time)
+
+    def stats(self):
+        """
+        Returns the per-stage counters and queue depths of every camera and the fusion stage.
+        """
+        stats = {s.name: s.stats() for s in self.stages}
+
+        for camera in self.cameras:
+            stats.update(camera.stats())
+
+        return stats
+
+    def video_feed(self, number=0):
+        """
+        Yields each new annotated frame from a camera to produce a live stream.
+        Returns None if the camera does not exist.
+        """
+        self.setup()
+
+        if not 0 <= number < len(self.cameras):
+            return None
+
+        return self.cameras[number].video_feed()
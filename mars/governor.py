@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+governor.py
+Adapts the camera framerate to what the robots are doing.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import json
+import threading
+import time
+
+import redis
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+
+
+class governor:
+    """
+    Chooses the camera framerate from the state of the Engineer and Alien:
+    - `FRAMERATE_MAX` while an enabled robot is near the next marker in its route
+    - `FRAMERATE` while a robot is moving
+    - `FRAMERATE_IDLE` when everything is stopped
+    """
+
+    def __init__(self):
+        self.rate = settings.FRAMERATE
+        self.check_time = 0
+        self.lock = threading.Lock()
+
+    def framerate(self):
+        """
+        Returns the current target framerate, recalculating it at most every `GOVERNOR_INTERVAL` seconds.
+        Safe to call from every camera.
+        """
+        if not settings.GOVERNOR:
+            return settings.FRAMERATE
+
+        with self.lock:
+            if time.time() - self.check_time > settings.GOVERNOR_INTERVAL:
+                self.check_time = time.time()
+
+                try:
+                    rate = self.calculate()
+                except Exception as e:
+                    log.warning(f"Unable to calculate framerate: {e}")
+                    rate = settings.FRAMERATE
+
+                if rate != self.rate:
+                    log.debug(f"Camera framerate changed to {rate} FPS")
+                    self.rate = rate
+
+            return self.rate
+
+    def calculate(self):
+        """
+        Calculates the framerate from the robot states in the database.
+        """
+        from mars import coords
+
+        enabled = {
+            "engineer": int(r.get("engineer_tasks_enabled") or 0),
+            "alien": int(r.get("alien_enabled") or 0)
+        }
+
+        moving = False
+
+        for device in ["engineer", "alien"]:
+            status = json.loads(r.get(f"{device}_current_status") or "{}")
+            moving = moving or status.get("moving", False)
+
+            if not enabled[device]:
+                continue
+
+            # Check if the robot is close to the next marker in its route
+            route = json.loads(r.get(f"{device}_target_route") or "[]")
+
+            if not route:
+                continue
+
+            vector = coords.coords().vector(device, route[0])
+
+            if vector and vector[0] < coords.scale_distance(settings.GOVERNOR_NEAR_RADIUS):
+                return settings.FRAMERATE_MAX
+
+        if moving:
+            return settings.FRAMERATE
+
+        return settings.FRAMERATE_IDLE
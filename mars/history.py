@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+history.py
+Recent positions of every aruco marker, kept in fixed size ring buffers.
+
+Memory use is fixed at `HISTORY_LENGTH` samples per marker, so the oldest samples are overwritten
+under continuous input. Used to find how fast a robot is moving or turning, and to plot trajectories.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from mars import logs, markers, settings
+
+log = logs.create_log(__name__)
+
+# History kept by the process which saves marker positions
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    """
+    Returns the marker history for this process, creating it if needed.
+    """
+    global _history
+
+    with _history_lock:
+        if _history is None:
+            _history = history()
+
+        return _history
+
+
+class history:
+    """
+    Ring buffer of [time, x, y, yaw] samples for every aruco id.
+    """
+
+    def __init__(self, size=None, length=settings.HISTORY_LENGTH):
+        size = size or markers.table_size()
+        self.length = length
+
+        self.samples = np.full((size, length, 4), np.nan)
+
+        # Index the next sample of each marker is written to, and the number of samples saved
+        self.head = np.zeros(size, dtype=int)
+        self.count = np.zeros(size, dtype=int)
+
+        self.lock = threading.Lock()
+
+    def append(self, ids, x, y, yaw, times):
+        """
+        Save a new sample for each marker in a batch.
+        """
+        ids = np.asarray(ids, dtype=int)
+
+        with self.lock:
+            self.samples[ids, self.head[ids]] = np.stack(
+                [times, x, y, yaw], axis=1)
+
+            self.head[ids] = (self.head[ids] + 1) % self.length
+            self.count[ids] = np.minimum(self.count[ids] + 1, self.length)
+
+    def last(self, index, seconds):
+        """
+        Returns the samples of a marker from the last `seconds`, oldest first.
+
+        @returns:
+        Array of [time, x, y, yaw] samples
+        """
+        with self.lock:
+            # Unroll the ring buffer into time order
+            order = (self.head[index] - self.count[index] +
+                     np.arange(self.count[index])) % self.length
+            samples = self.samples[index, order]
+
+        # Samples are in time order, so the window starts at the first recent sample
+        start = np.searchsorted(samples[:, 0], time.time() - seconds)
+
+        return samples[start:]
+
+    def velocity(self, index, seconds=None):
+        """
+        Estimates the velocity and yaw rate of a marker by a least squares fit over the last `seconds`.
+
+        @returns:
+        vx, vy, yaw_rate - Per second, or None if there are not enough samples
+        """
+        if seconds is None:
+            seconds = settings.HISTORY_VELOCITY_WINDOW
+
+        samples = self.last(index, seconds)
+
+        if len(samples) < 2 or samples[-1, 0] == samples[0, 0]:
+            return None
+
+        times = samples[:, 0] - samples[0, 0]
+
+        # Yaw is unwrapped so turning through +/- pi is continuous
+        values = np.stack([samples[:, 1], samples[:, 2],
+                           np.unwrap(samples[:, 3])], axis=1)
+
+        slopes = np.polyfit(times, values, 1)[0]
+
+        return tuple(float(slope) for slope in slopes)
+
+    def speed(self, index, seconds, minimum):
+        """
+        Estimates the average speed of a marker while it was moving over the last `seconds`.
+        Steps slower than `minimum` per second are left out, so time spent stopped does not lower the speed.
+
+        @returns:
+        Speed per second, or None if the marker has not moved
+        """
+        samples = self.last(index, seconds)
+
+        if len(samples) < 2:
+            return None
+
+        times = np.diff(samples[:, 0])
+        steps = np.hypot(np.diff(samples[:, 1]), np.diff(samples[:, 2]))
+
+        moving = (times > 0) & (steps > minimum * times)
+
+        if not moving.any():
+            return None
+
+        return float(steps[moving].sum() / times[moving].sum())
+
+    def downsample(self, index, seconds, points):
+        """
+        Returns the samples of a marker from the last `seconds`, averaged into at most `points` samples.
+        Used to plot trajectories without sending every frame.
+        """
+        samples = self.last(index, seconds)
+
+        if len(samples) <= points:
+            return samples
+
+        bins = np.array_split(samples, points)
+
+        downsampled = np.array([group.mean(axis=0) for group in bins])
+
+        # Yaw is averaged around the circle
+        downsampled[:, 3] = [np.arctan2(np.sin(group[:, 3]).mean(), np.cos(group[:, 3]).mean())
+                             for group in bins]
+
+        return downsampled
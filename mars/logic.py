@@ -8,11 +8,12 @@ Mechatronics 2
 """
 
 import json
+import math
 import time
 
 import redis
 
-from mars import coords, logs, settings
+from mars import coords, doors, logs, maps, settings
 from mars.comms import commands
 
 log = logs.create_log(__name__)
@@ -48,22 +49,18 @@ def update_ui():
                 "enabled": int(r.get("alien_enabled") or -1),
                 "target_route": r.get("alien_target_route"),
             },
-            "doors": {
-                "A": doors_state[0],
-                "B": doors_state[1],
-                "C": doors_state[2],
-                "D": doors_state[3]}
+            "doors": {chr(ord("A") + index): state for index, state in enumerate(doors_state)}
         }
     ))
 
 
 class engineer:
     def __init__(self):
-        # General route the Engineer wishes to take:
+        # General route the Engineer wishes to take, from the compound map:
         # - Start at launch pad
         # - Complete tasks in order: 1, 2, 3
         # - Return to launch pad
-        self.desired_path = [2, 17, 9, 12, 2]
+        self.desired_path = maps.load().tasks
 
     def setup(self):
         """
@@ -73,12 +70,10 @@ class engineer:
         r.set("engineer_current_task", 0)
 
         # Last known position in the compound
-        r.set("engineer_current_marker", 2)
+        doors.move("engineer", current=maps.load().start["engineer"], route=[])
 
         r.set("engineer_tasks_enabled", 0)
 
-        r.set("engineer_target_route", "[]")
-
     def engineer_complete_tasks(self):
         """
         Function to go through all tasks and complete them in sequence.
@@ -95,6 +90,26 @@ class engineer:
         while int(r.get("engineer_tasks_enabled")):
             self.next_task()
 
+    def plan_route(self, route_planner, target_marker, avoid=None):
+        """
+        Plans the route from the current marker to `target_marker`.
+        While the Alien is active, the route keeps clear of where it is predicted to be, and may wait for it to pass;
+        otherwise the route is repaired by the incremental `route_planner`, avoiding `avoid`.
+
+        @returns:
+        target_route - A list of codes to travel through, or False if no route was found
+        depart - Time to leave the current marker
+        """
+        start = int(r.get("engineer_current_marker"))
+
+        if settings.SPACETIME and int(r.get("alien_enabled") or 0):
+            target_route, depart = coords.route().spacetime(start, target_marker)
+
+            if target_route:
+                return target_route, depart
+
+        return coords.route().replan(route_planner, start, target_marker, avoid=avoid), time.time()
+
     def next_task(self):
         """
         Aims to complete the next task in the task list for the Engineer.
@@ -103,8 +118,8 @@ class engineer:
         update_ui()
 
         # Determine route to get to next task
-        r.set("engineer_current_marker",
-              self.desired_path[int(r.get("engineer_current_task"))])
+        doors.move("engineer", current=self.desired_path[int(
+            r.get("engineer_current_task"))])
 
         try:
             target_marker = self.desired_path[int(
@@ -116,12 +131,13 @@ class engineer:
             self.setup()
             return
 
-        # Find initial target route
-        target_route = coords.route().pathfinder(
-            int(r.get("engineer_current_marker")), target_marker)
+        # Find initial target route; the planner is kept to repair the route as things change
+        route_planner = coords.route().session()
+
+        target_route, depart = self.plan_route(route_planner, target_marker)
 
         log.info(f"Engineer working on next task: {target_route}")
-        r.set("engineer_target_route", str(target_route))
+        doors.move("engineer", route=target_route)
 
         reached_target = False
 
@@ -136,14 +152,43 @@ class engineer:
             comms_start_time = time.time()
             data_start_time = time.time()
 
+            # Set while the robot has not been seen recently, or is waiting for the Alien to pass
+            lost = False
+            holding = False
+
             while not reached_marker:
                 # Break from loops if required
                 if not int(r.get("engineer_tasks_enabled")):
                     return
 
+                # Stop rather than steer by an old position if the Engineer has not been seen
+                if coords.coords().is_stale("engineer"):
+                    if not lost:
+                        log.warning("Engineer lost! Stopping until it is seen again...")
+                        self.cmd.stop("engineer")
+                        lost = True
+
+                    time.sleep(1 / settings.FRAMERATE)
+                    continue
+
+                lost = False
+
+                # Wait at the current marker until the Alien has passed
+                if time.time() < depart:
+                    if not holding:
+                        log.info(
+                            f"Engineer waiting {depart - time.time():.1f}s for the Alien to pass")
+                        self.cmd.stop("engineer")
+                        holding = True
+
+                    time.sleep(1 / settings.FRAMERATE)
+                    continue
+
+                holding = False
+
                 try:
                     # Calculate distance to next marker in route
-                    magnitude, direction = coords.coords().calculate_vector(
+                    magnitude, direction = coords.coords().vector(
                         "engineer", target_route[0])
 
                 except TypeError:
@@ -151,39 +196,52 @@ class engineer:
                     return
 
                 # If within target radius of target marker
-                if magnitude < settings.MARKER_RADIUS_ENGINEER:
+                if magnitude < coords.scale_distance(settings.MARKER_RADIUS_ENGINEER):
                     log.info("Engineer within target marker radius!")
                     log.info("Moving to next marker...")
 
                     # Update current position
-                    r.set("engineer_current_marker", target_route[0])
+                    doors.move("engineer", current=target_route[0])
 
                     # Remove from route
                     target_route.pop(0)
                     reached_marker = True
 
+                    # Repair the rest of the route if doors have changed, or the Alien is nearby or on its way
+                    if target_route:
+                        avoid = int(r.get("alien_current_marker")
+                                    ) if within_alien_radius else None
+
+                        new_target_route, depart = self.plan_route(
+                            route_planner, target_marker, avoid=avoid)
+
+                        if new_target_route and new_target_route[1:] != target_route:
+                            target_route = new_target_route[1:]
+                            log.info(
+                                f"Engineer route changed: {target_route}")
+
                     # Update UI route
-                    r.set("engineer_target_route", str(target_route))
+                    doors.move("engineer", route=target_route)
 
                 else:
-                    # Calculate distance to alien
-                    alien_distance, _ = coords.coords().calculate_vector(
-                        "engineer", "alien")
+                    # Calculate distance to alien; an alien which hasn't been seen can't be heard
+                    alien_vector = coords.coords().vector("engineer", "alien")
+                    alien_distance = alien_vector[0] if alien_vector else math.inf
 
                     # Keep looping until engineer is out of radius of Alien
                     if within_alien_radius:
-                        if alien_distance > settings.DETECTION_RADIUS * 1.1:
+                        if alien_distance > coords.scale_distance(settings.DETECTION_RADIUS) * 1.1:
                             log.info(
                                 "Engineer no longer within radius of Alien")
                             within_alien_radius = False
 
-                    # If within hearing distance, re-calculate route with alien avoidance
-                    elif alien_distance < settings.DETECTION_RADIUS:
+                    # If within hearing distance, repair route with alien avoidance; the engineer keeps moving
+                    elif alien_distance < coords.scale_distance(settings.DETECTION_RADIUS):
                         log.info("Engineer within hearing distance of alien!")
                         log.info(
                             f"Avoiding Alien at marker: {int(r.get('alien_current_marker'))}")
-                        new_target_route = coords.route().pathfinder(
-                            int(r.get("engineer_current_marker")), target_marker, avoid=int(r.get("alien_current_marker")))
+                        new_target_route = coords.route().replan(
+                            route_planner, int(r.get("engineer_current_marker")), target_marker, avoid=int(r.get("alien_current_marker")))
 
                         # Check if no route has been found, if so throw a fit
                         if not new_target_route:
@@ -204,19 +262,17 @@ class engineer:
 
                         log.info(
                             f"Engineer working on next task: {target_route}")
-                        r.set("engineer_target_route", str(target_route))
+                        doors.move("engineer", route=target_route)
 
                         within_alien_radius = True
 
-                        # Tell engineer to stop moving
-                        self.cmd.stop("engineer")
-
                     # Only send if the next message is required
                     comms_time_remain = comms_start_time + 1 / settings.COMMSRATE - time.time()
 
                     if comms_time_remain < 0:
                         # Send a command to go to the first marker in the route
-                        self.cmd.simple_engineer_move(magnitude, direction)
+                        self.cmd.simple_engineer_move(
+                            magnitude, direction, coords.coords().capture_time("engineer", target_route[0]))
 
                         comms_start_time = time.time()
 
@@ -247,8 +303,7 @@ class alien:
         """
         # Last known position in the compound
         r.set("alien_enabled", 0)
-        r.set("alien_current_marker", 9)
-        r.set("alien_target_route", "[]")
+        doors.move("alien", current=maps.load().start["alien"], route=[])
 
         # Initialise comms object
         self.cmd = commands()
@@ -267,6 +322,7 @@ class alien:
             # Determine route to get to next task
             target_marker = int(r.get("engineer_current_marker"))
 
+            # The Engineer keeps moving, so routes are looked up rather than repaired
             target_route = coords.route().pathfinder(
                 int(r.get("alien_current_marker")), target_marker, shortcuts=True)
 
@@ -279,7 +335,7 @@ class alien:
                 continue
 
             log.info(f"Alien following route: {target_route}")
-            r.set("alien_target_route", str(target_route))
+            doors.move("alien", route=target_route)
 
             reached_marker = False
 
@@ -287,14 +343,29 @@ class alien:
             comms_start_time = time.time()
             data_start_time = time.time()
 
+            # Set while the robot has not been seen recently
+            lost = False
+
             while not reached_marker:
                 # Break from loops if required
                 if not int(r.get("alien_enabled")):
                     return
 
+                # Stop rather than steer by an old position if the Alien has not been seen
+                if coords.coords().is_stale("alien"):
+                    if not lost:
+                        log.warning("Alien lost! Stopping until it is seen again...")
+                        self.cmd.stop("alien")
+                        lost = True
+
+                    time.sleep(1 / settings.FRAMERATE)
+                    continue
+
+                lost = False
+
                 try:
                     # Calculate distance to next marker in route
-                    magnitude, direction = coords.coords().calculate_vector(
+                    magnitude, direction = coords.coords().vector(
                         "alien", target_route[0])
 
                 except TypeError:
@@ -302,19 +373,17 @@ class alien:
                     return
 
                 # If within target radius of target marker
-                if magnitude < settings.MARKER_RADIUS:
+                if magnitude < coords.scale_distance(settings.MARKER_RADIUS):
                     log.info("Alien within target marker radius!")
                     log.info("Moving to next marker...")
 
-                    # Update current position
-                    r.set("alien_current_marker", target_route[0])
-
-                    # Remove from route
-                    target_route.pop(0)
+                    # Update current position and remove from route
+                    current_marker = target_route.pop(0)
                     reached_marker = True
 
                     # Update route in UI
-                    r.set("alien_target_route", str(target_route))
+                    doors.move("alien", current=current_marker,
+                               route=target_route)
 
                 else:
                     # Only send if the next message is required
@@ -322,7 +391,8 @@ class alien:
 
                     if comms_time_remain < 0:
                         # Send a command to go to the first marker in the route
-                        self.cmd.simple_alien_move(magnitude, direction)
+                        self.cmd.simple_alien_move(
+                            magnitude, direction, coords.coords().capture_time("alien", target_route[0]))
 
                         comms_start_time = time.time()
 
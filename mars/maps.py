@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+maps.py
+Loads compound maps from versioned files in mars/maps.
+
+A map file lists the allowed routes from every marker in order, which sets how ties between
+equally short routes are broken, along with the doors, the vents only the Alien can use, and
+the Engineer's tasks. Routes are held in compressed sparse row (CSR) arrays so large maps can
+be searched without building Python lists for every marker.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+# Map file versions which can be loaded
+SUPPORTED_VERSIONS = [1]
+
+# Maps already loaded, by path
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+def path(name=None):
+    """
+    Returns the path of a map file from its name, or from the `MAP` environment variable or `settings.MAP`.
+    """
+    name = name or os.getenv("MAP") or settings.MAP
+
+    if os.path.splitext(name)[1]:
+        return name
+
+    return os.path.join("mars", "maps", f"{name}.json")
+
+
+def load(name=None):
+    """
+    Returns a map, loading it from its file the first time it is needed.
+    """
+    map_path = path(name)
+
+    with _maps_lock:
+        if map_path not in _maps:
+            with open(map_path) as f:
+                _maps[map_path] = compound_map(json.load(f))
+
+            log.debug(f"Map loaded: {map_path}")
+
+        return _maps[map_path]
+
+
+def csr(graph):
+    """
+    Converts a list of allowed next markers from each marker into CSR arrays.
+    The allowed next markers from `a` are `indices[indptr[a]:indptr[a + 1]]`, in the same order.
+    """
+    lengths = np.array([len(points) for points in graph], dtype=int)
+
+    indptr = np.zeros(len(graph) + 1, dtype=int)
+    np.cumsum(lengths, out=indptr[1:])
+
+    indices = np.fromiter((point for points in graph for point in points),
+                          dtype=int, count=indptr[-1])
+
+    return indptr, indices
+
+
+def grid(rows, columns, doors=0, seed=0):
+    """
+    Generates a map of markers in a grid, each connected to its neighbours, for stress testing.
+    Randomly chosen routes between neighbours become doors.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Markers 0 and 1 are reserved for the robots
+    def code(row, column):
+        return 2 + row * columns + column
+
+    routes = [[], []]
+
+    for row in range(rows):
+        for column in range(columns):
+            routes.append([code(r, c)
+                           for r, c in [(row - 1, column), (row, column - 1), (row, column + 1), (row + 1, column)]
+                           if 0 <= r < rows and 0 <= c < columns])
+
+    edges = [[a, b] for a, points in enumerate(routes) for b in points if a < b]
+    door_edges = rng.choice(len(edges), size=doors, replace=False)
+
+    return compound_map({
+        "version": SUPPORTED_VERSIONS[-1],
+        "name": f"Grid {rows}x{columns}",
+        "markers": len(routes),
+        "entities": {"engineer": 0, "alien": 1, "entrance": 2},
+        "start": {"engineer": 2, "alien": len(routes) - 1},
+        "tasks": [2, len(routes) - 1, 2],
+        "routes": routes,
+        "doors": [edges[index] for index in door_edges],
+        "vents": []
+    })
+
+
+class compound_map:
+    """
+    Markers, routes, doors and tasks of a compound.
+    """
+
+    def __init__(self, data):
+        if data.get("version") not in SUPPORTED_VERSIONS:
+            raise ValueError(
+                f"Unsupported map version: {data.get('version')}")
+
+        self.version = data["version"]
+        self.name = data.get("name", "")
+
+        # Number of aruco ids in the compound, including the robots
+        self.markers = data["markers"]
+
+        self.entities = data["entities"]
+        self.start = data["start"]
+        self.tasks = data["tasks"]
+        self.names = {int(code): name for code,
+                      name in data.get("names", {}).items()}
+
+        # Routes allowed for the engineer
+        self.routes = [list(points) for points in data["routes"]]
+
+        if len(self.routes) != self.markers:
+            raise ValueError(
+                f"Map has routes for {len(self.routes)} of {self.markers} markers")
+
+        # Markers which require a check for an open door
+        self.doors = [list(door) for door in data["doors"]]
+
+        # Update shortcuts for alien
+        self.vents = [list(vent) for vent in data.get("vents", [])]
+        self.routes_alien = [list(points) for points in self.routes]
+
+        for vent in self.vents:
+            self.routes_alien[vent[0]].append(vent[1])
+            self.routes_alien[vent[1]].append(vent[0])
+
+        self.csr = {
+            False: csr(self.routes),
+            True: csr(self.routes_alien)
+        }
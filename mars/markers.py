@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+markers.py
+Table of the latest position of every aruco marker, held in shared memory.
+
+Readers in any process attach to the same table by name, so positions are read without a
+database request or any parsing. Each row is protected by a version counter (a seqlock): the
+writer makes it odd while a row is being changed, and readers retry until they copy a row
+with the same even version before and after. A header records the layout, size and creating process,
+so a table left behind by a run which did not exit cleanly is replaced rather than read.
+
+Positions can also be mirrored to Redis for readers outside the Python system, as fixed width
+binary records in a single hash. Markers which have not moved are not written again.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import atexit
+import os
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import redis
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+# Layout of each row of the table
+ROW = np.dtype([
+    ("version", "<i8"),     # Seqlock counter, odd while the row is being written
+    ("seq", "<i8"),         # Number of times the marker has been updated, 0 if never seen
+    ("x", "<f8"),
+    ("y", "<f8"),
+    ("yaw", "<f8"),
+    ("vx", "<f8"),          # Velocity and yaw rate per second, to predict the position between frames
+    ("vy", "<f8"),
+    ("yaw_rate", "<f8"),
+    ("time", "<f8")         # Capture time of the frame the position came from
+])
+
+# Header at the start of the table, to recognise a table left behind by an earlier run
+HEADER = np.dtype([
+    ("magic", "<u8"),
+    ("row_size", "<i8"),    # Checked so a table with an old row layout is not used
+    ("size", "<i8"),        # Number of rows
+    ("pid", "<i8")          # Process which created the table
+])
+
+MAGIC = int.from_bytes(b"MARSTBL1", "little")
+
+# Attempts to read a row which is being written before giving up
+READ_ATTEMPTS = 100
+
+# Record of a marker mirrored to Redis: x, y, yaw, capture time, update count
+RECORD = struct.Struct("<fffdI")
+
+# Table shared by everything in this process
+_table = None
+_table_lock = threading.Lock()
+
+# Mirror used by the process which saves marker positions
+_mirror = None
+
+
+def get_table():
+    """
+    Returns the marker table for this process, creating or attaching to the shared memory block if needed.
+    """
+    global _table
+
+    with _table_lock:
+        if _table is None:
+            _table = table()
+
+        return _table
+
+
+def use_table(name):
+    """
+    Makes this process use its own marker table instead of the shared one, so its positions never reach the robots.
+    The table is removed when the process exits.
+    """
+    global _table
+
+    with _table_lock:
+        _table = table(name)
+
+        return _table
+
+
+def table_size():
+    """
+    Returns the number of aruco ids held in the marker table; enough for every marker in the compound map.
+    """
+    from mars import maps
+
+    return max(settings.MARKER_TABLE_SIZE, maps.load().markers)
+
+
+def get_mirror():
+    """
+    Returns the Redis mirror of the marker table for this process, creating it if needed.
+    """
+    global _mirror
+
+    with _table_lock:
+        if _mirror is None:
+            _mirror = mirror()
+
+        return _mirror
+
+
+def alive(pid):
+    """
+    Returns True if the process `pid` is still running.
+    """
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def encode(x, y, yaw, timestamp, seq):
+    """
+    Packs the position of a marker into a binary record.
+    """
+    return RECORD.pack(x, y, yaw, timestamp, seq)
+
+
+def decode(record):
+    """
+    Unpacks a binary record into [x_pos, y_pos, yaw, capture_time, seq].
+    """
+    return list(RECORD.unpack(record))
+
+
+class table:
+    """
+    Fixed size array of marker positions, indexed by aruco id.
+    """
+
+    def __init__(self, name=settings.MARKER_TABLE_NAME, size=None):
+        size = size or table_size()
+        self.size = size
+        self.write_lock = threading.Lock()
+
+        try:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+            header = self.header()
+
+            if header is None or not alive(header["pid"]):
+                # Left behind by a run which did not exit cleanly
+                log.warning(f"Replacing stale marker table: {name}")
+
+                self.memory.close()
+                self.memory.unlink()
+                self.memory = None
+
+            else:
+                # Still in use, so it cannot be replaced even if made for a smaller map
+                if header["size"] < size:
+                    log.error(f"Marker table {name} holds {header['size']} markers but {size} are needed, "
+                              "restart every process to resize it")
+
+                size = self.size = int(header["size"])
+
+                # Only the process which created the table may remove it
+                resource_tracker.unregister(
+                    self.memory._name, "shared_memory")
+
+                log.debug(f"Attached to marker table: {name}")
+
+        except FileNotFoundError:
+            self.memory = None
+
+        if self.memory is None:
+            self.memory = shared_memory.SharedMemory(
+                name=name, create=True, size=HEADER.itemsize + size * ROW.itemsize)
+            self.owner = True
+
+            log.debug(f"Created marker table: {name}")
+
+        self.rows = np.ndarray((size,), dtype=ROW, buffer=self.memory.buf,
+                               offset=HEADER.itemsize)
+
+        if self.owner:
+            self.rows[:] = 0
+
+            header = np.ndarray((), dtype=HEADER, buffer=self.memory.buf)
+            header["row_size"], header["size"], header["pid"] = ROW.itemsize, size, os.getpid()
+            header["magic"] = MAGIC
+            del header
+
+        atexit.register(self.close)
+
+    def header(self):
+        """
+        Returns a copy of the table header, or None if the shared memory block is not a marker table with the current layout.
+        """
+        if self.memory.size < HEADER.itemsize:
+            return None
+
+        header = np.ndarray((), dtype=HEADER, buffer=self.memory.buf).copy()
+
+        if header["magic"] != MAGIC or header["row_size"] != ROW.itemsize:
+            return None
+
+        if self.memory.size < HEADER.itemsize + header["size"] * ROW.itemsize:
+            return None
+
+        return header
+
+    def write(self, ids, x, y, yaw, vx, vy, yaw_rate, times):
+        """
+        Save new positions for a batch of markers.
+        """
+        with self.write_lock:
+            for values in zip(ids, x, y, yaw, vx, vy, yaw_rate, times):
+                index = values[0]
+                row = self.rows[index:index + 1]
+
+                row["version"] += 1
+                row["x"], row["y"], row["yaw"] = values[1:4]
+                row["vx"], row["vy"], row["yaw_rate"] = values[4:7]
+                row["time"] = values[7]
+                row["seq"] += 1
+                row["version"] += 1
+
+    def read(self, index):
+        """
+        Get the latest position of a single marker.
+
+        @returns:
+        Row of the table, or None if the marker has never been seen
+        """
+        for _ in range(READ_ATTEMPTS):
+            version = self.rows["version"][index]
+            row = self.rows[index].copy()
+
+            if version % 2 == 0 and version == self.rows["version"][index]:
+                break
+        else:
+            log.warning(f"Unable to read marker table row: {index}")
+            return None
+
+        if row["seq"] == 0:
+            return None
+
+        return row
+
+    def read_many(self, ids):
+        """
+        Get the latest positions of several markers at once.
+
+        @returns:
+        Copy of the rows of the table; markers which have never been seen have `seq` 0
+        """
+        ids = np.asarray(ids, dtype=int)
+
+        for _ in range(READ_ATTEMPTS):
+            versions = self.rows["version"][ids]
+            rows = self.rows[ids]
+
+            if not (versions % 2).any() and (versions == self.rows["version"][ids]).all():
+                return rows
+
+        log.warning("Unable to read marker table rows")
+        rows[:] = 0
+        return rows
+
+    def close(self):
+        """
+        Detach from the table, removing it if created by this process.
+        """
+        if self.memory is None:
+            return
+
+        del self.rows
+        self.memory.close()
+
+        if self.owner:
+            self.memory.unlink()
+
+        self.memory = None
+
+
+class mirror:
+    """
+    Copies marker positions to the `MARKER_REDIS_KEY` hash in Redis, keyed by aruco id.
+    A marker is only written when it has moved by more than the deadband, or its record is older than `MARKER_MIRROR_INTERVAL`.
+    """
+
+    def __init__(self, size=None):
+        from mars import coords, tracker
+
+        size = size or table_size()
+
+        # Records are binary, so responses must not be decoded
+        self.r = redis.Redis(host='localhost', port=6379, db=0)
+
+        self.deadband = coords.scale_distance(settings.MARKER_DEADBAND)
+        self.wrap = tracker.wrap
+
+        # Last [x, y, yaw] and time written for each marker
+        self.written = np.full((size, 3), np.nan)
+        self.write_time = np.zeros(size)
+
+    def write(self, ids, rows):
+        """
+        Mirror the rows of the marker table for a batch of markers, in a single request.
+        """
+        ids = np.asarray(ids, dtype=int)
+        positions = np.stack([rows["x"], rows["y"], rows["yaw"]], axis=1)
+
+        change = np.abs(positions - self.written[ids])
+
+        # Yaw of +pi and -pi are the same heading
+        change[:, 2] = np.abs(self.wrap(positions[:, 2] - self.written[ids, 2]))
+
+        # NaN for markers never written, which always counts as moved
+        moved = ~((change[:, 0] <= self.deadband) & (change[:, 1] <= self.deadband) &
+                  (change[:, 2] <= settings.MARKER_YAW_DEADBAND))
+
+        now = time.time()
+        due = moved | (now - self.write_time[ids] > settings.MARKER_MIRROR_INTERVAL)
+
+        if not due.any():
+            return
+
+        self.r.hset(settings.MARKER_REDIS_KEY, mapping={
+            int(index): encode(*row[["x", "y", "yaw", "time", "seq"]].tolist())
+            for index, row in zip(ids[due], rows[due])
+        })
+
+        self.written[ids[due]] = positions[due]
+        self.write_time[ids[due]] = now
+
+    def read(self, ids):
+        """
+        Read the mirrored positions of several markers in a single request.
+
+        @returns:
+        List of [x_pos, y_pos, yaw, capture_time, seq] for each marker, or None if not mirrored
+        """
+        records = self.r.hmget(settings.MARKER_REDIS_KEY, [int(index) for index in ids])
+
+        return [decode(record) if record else None for record in records]
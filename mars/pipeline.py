@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+pipeline.py
+Building blocks for running the vision system as separate stages connected by bounded buffers.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import threading
+import time
+from collections import deque
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+
+class ring_buffer:
+    """
+    Bounded buffer used to hand frames between stages.
+    When full the oldest item is dropped, and readers always take the newest item,
+    discarding anything older so the next stage works on the freshest frame.
+    """
+
+    def __init__(self, name, size=None):
+        self.name = name
+        self.items = deque(maxlen=size or settings.PIPELINE_BUFFER_SIZE)
+        self.condition = threading.Condition()
+
+        # Counters for monitoring
+        self.pushed = 0
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Add an item, dropping the oldest if the buffer is full.
+        """
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+
+            self.items.append(item)
+            self.pushed += 1
+
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Wait for and return the newest item, or None if the timeout expires.
+        Older items still waiting are counted as dropped.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items, timeout):
+                return None
+
+            item = self.items.pop()
+
+            self.dropped += len(self.items)
+            self.items.clear()
+
+            return item
+
+    def depth(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "pushed": self.pushed,
+            "dropped": self.dropped
+        }
+
+
+class stage:
+    """
+    Runs `func` repeatedly in its own thread.
+    Items are read from the `source` buffer (if given) and passed to `func`,
+    and anything returned is written to the `sink` buffer (if given).
+    """
+
+    def __init__(self, name, func, source=None, sink=None):
+        self.name = name
+        self.func = func
+        self.source = source
+        self.sink = sink
+
+        # Counters for monitoring
+        self.processed = 0
+        self.busy_time = 0
+
+        self.thread = None
+
+    def start(self, running):
+        """
+        Start the stage thread, which runs while `running()` is True.
+        """
+        self.thread = threading.Thread(
+            target=self.run, args=(running,), name=self.name, daemon=True)
+        self.thread.start()
+
+    def run(self, running):
+        while running():
+            if self.source is not None:
+                item = self.source.get(timeout=settings.PIPELINE_TIMEOUT)
+
+                # Nothing arrived, check if the pipeline is still running
+                if item is None:
+                    continue
+
+                start_time = time.time()
+                result = self.func(item)
+
+            else:
+                start_time = time.time()
+                result = self.func()
+
+            self.busy_time += time.time() - start_time
+            self.processed += 1
+
+            if result is not None and self.sink is not None:
+                self.sink.put(result)
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        stats = {
+            "processed": self.processed,
+            "busy_time": round(self.busy_time, 3)
+        }
+
+        if self.source is not None:
+            stats["queue"] = self.source.stats()
+
+        return stats
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+recorder.py
+Records raw JPEG camera frames to a single indexed file, and reads them back for replay.
+
+File layout:
+    header  - MAGIC, version
+    frames  - [timestamp (float64), length (uint32), JPEG bytes] for each frame
+    index   - [offset (uint64), timestamp (float64), length (uint32)] for each frame
+    footer  - index offset (uint64), frame count (uint32), INDEX_MAGIC
+
+The index is written when the recording is closed. If a recording was not closed
+cleanly, the index is rebuilt by scanning the frames.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+from mars import logs
+
+log = logs.create_log(__name__)
+
+MAGIC = b"MARSREC\0"
+INDEX_MAGIC = b"MARSIDX\0"
+VERSION = 1
+
+HEADER = struct.Struct("<8sI")
+FRAME = struct.Struct("<dI")
+FOOTER = struct.Struct("<QI8s")
+
+INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("time", "<f8"),
+    ("length", "<u4")])
+
+
+class recorder:
+    """
+    Appends raw JPEG frames with timestamps to a recording file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+
+        self.index = []
+
+        log.info(f"Recording camera frames to: {path}")
+
+    def write(self, jpeg, timestamp):
+        """
+        Append a single frame.
+        """
+        offset = self.file.tell() + FRAME.size
+
+        self.file.write(FRAME.pack(timestamp, len(jpeg)))
+        self.file.write(jpeg)
+
+        self.index.append((offset, timestamp, len(jpeg)))
+
+    def close(self):
+        """
+        Write the index and footer, then close the file.
+        """
+        if self.file.closed:
+            return
+
+        index_offset = self.file.tell()
+
+        self.file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self.file.write(FOOTER.pack(index_offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+        log.info(f"Recorded {len(self.index)} frames to: {self.path}")
+
+
+class recording:
+    """
+    Memory maps a recording file for reading.
+    `index` is an array of frame offsets, timestamps and lengths.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a camera recording: {path}")
+
+        self.index = self.read_index()
+
+    def read_index(self):
+        """
+        Read the index from the footer, or rebuild it if the recording was not closed.
+        """
+        if len(self.map) >= HEADER.size + FOOTER.size:
+            index_offset, count, magic = FOOTER.unpack_from(
+                self.map, len(self.map) - FOOTER.size)
+
+            if magic == INDEX_MAGIC:
+                return np.frombuffer(self.map, dtype=INDEX_DTYPE,
+                                     count=count, offset=index_offset)
+
+        log.warning(f"Recording has no index, rebuilding: {self.path}")
+
+        index = []
+        position = HEADER.size
+
+        while position + FRAME.size <= len(self.map):
+            timestamp, length = FRAME.unpack_from(self.map, position)
+            position += FRAME.size
+
+            # Frame was only partially written
+            if position + length > len(self.map):
+                break
+
+            index.append((position, timestamp, length))
+            position += length
+
+        return np.array(index, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, number):
+        """
+        Returns the timestamp and raw JPEG bytes of a frame.
+        """
+        offset, timestamp, length = self.index[number]
+
+        return float(timestamp), self.map[int(offset):int(offset) + int(length)]
+
+    def close(self):
+        # Index must be released before the map can be closed
+        self.index = None
+        self.map.close()
@@ -0,0 +1,627 @@
+#!/usr/bin/env python3
+"""
+routing.py
+Route planning over the Engineer and Alien compound graphs.
+
+Routes with the fewest markers are found from the number of markers to the finish from every
+other marker, calculated once by a breadth first search out from the finish. The route is then
+followed from the start, taking the first allowed next marker which is one closer each time, so
+ties are broken in the order markers are listed in the map. These searches are calculated ahead
+for every combination of closed doors on small maps, and kept once calculated on larger maps.
+
+When the positions of the compound markers are known, routes are instead weighted by the
+distance between markers. These routes are kept until any marker moves by more than the
+geometry tolerance; until every marker has been seen, the last complete positions are used,
+or the fewest markers if there are none.
+
+A robot following a route keeps an incremental planner (D* Lite), which repairs its route
+in place when a door or marker is blocked or reopened, and as the robot moves along it.
+
+The Engineer can also plan in space and time, keeping clear of the markers the Alien is
+predicted to reach along its own route, and waiting at its start marker if that is quicker.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import heapq
+import itertools
+import math
+import threading
+
+import numpy as np
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+
+def hops_to(indptr, indices, sources, allowed, finish):
+    """
+    Breadth first search back from `finish`, over the routes of a CSR graph which are `allowed`.
+    `sources` is the marker each route starts from.
+
+    @returns:
+    Number of markers to travel through to reach the finish from every marker, or -1 if it can't be reached
+    """
+    hops = np.full(len(indptr) - 1, -1, dtype=np.int32)
+    hops[finish] = 0
+
+    # Routes grouped by the marker they lead to
+    order = np.argsort(indices, kind="stable")
+    order = order[allowed[order]]
+    into = np.searchsorted(indices[order], np.arange(len(indptr)))
+
+    frontier = np.array([finish])
+    distance = 0
+
+    while len(frontier):
+        distance += 1
+
+        # Every allowed route into the frontier
+        starts, ends = into[frontier], into[frontier + 1]
+        counts = ends - starts
+
+        routes = np.repeat(starts - np.cumsum(counts) + counts, counts) + \
+            np.arange(counts.sum())
+        previous = sources[order[routes]]
+
+        frontier = np.unique(previous[hops[previous] == -1])
+        hops[frontier] = distance
+
+    return hops
+
+
+def overlaps(intervals, start, end):
+    """
+    Check if the time from `start` to `end` overlaps any of the (start, end) `intervals`.
+    """
+    return any(start <= other_end and other_start <= end for other_start, other_end in intervals)
+
+
+def reservations(route, arrivals, nearby, margin, horizon):
+    """
+    Reserves the markers the Alien is predicted to be close to as it follows its route.
+
+    `route` is the markers the Alien will travel through, starting from its current marker,
+    `arrivals` the predicted time it reaches each, and `nearby` the markers close enough to hear
+    it from each marker. Each marker is reserved from `margin` seconds before the Alien arrives
+    until `margin` seconds after it leaves, and the last marker until `horizon`.
+
+    @returns:
+    markers - Dictionary of reserved (start, end) times for each marker
+    routes - Dictionary of reserved (start, end) times for each route, as (from, to) pairs
+    """
+    markers = {}
+    routes = {}
+
+    for index, code in enumerate(route):
+        arrive = arrivals[index] - margin
+
+        if index + 1 < len(route):
+            leave = arrivals[index + 1] + margin
+
+            # Meeting the Alien head on between two markers
+            routes.setdefault((route[index + 1], code), []).append(
+                (arrive, leave))
+        else:
+            leave = horizon
+
+        for point in nearby(code):
+            markers.setdefault(point, []).append((arrive, leave))
+
+    return markers, routes
+
+
+def spacetime(planner, start, finish, doors_state, reserved, travel_time, now, shortcuts=False):
+    """
+    Finds the route which reaches the finish soonest without entering a reserved marker or route
+    while it is reserved, using A* over (marker, time).
+    The robot may wait at `start` in steps of `SPACETIME_STEP` seconds before leaving.
+    Nothing is reserved past `SPACETIME_HORIZON`, so the rest of a route which reaches the horizon
+    is the route with the fewest markers from there.
+
+    `reserved` are the (markers, routes) reservations, and `travel_time(a, b)` the seconds to travel between markers.
+
+    @returns:
+    route - List of markers from `start` to `finish`, or None if there is no route
+    depart - Time to leave `start`
+    """
+    reserved_markers, reserved_routes = reserved
+
+    closed = tuple(index for index, door in enumerate(planner.markers_doors)
+                   if not doors_state[index] and start in door)
+
+    hops = planner.search(shortcuts, closed, None, finish)
+
+    if start == finish or hops[start] == -1:
+        return None, now
+
+    indptr, indices, _ = planner.csr[shortcuts]
+    allowed = planner.mask(shortcuts, closed, None)
+
+    # Lower bound of the time to the finish, for the heuristic
+    fastest = min(travel_time(a, int(b)) for a in range(len(indptr) - 1)
+                  for b in indices[indptr[a]:indptr[a + 1]])
+
+    step = settings.SPACETIME_STEP
+    horizon = now + settings.SPACETIME_HORIZON
+
+    # Queue of (estimated arrival time, order added, marker, time); states are (marker, time step)
+    queue = []
+    parents = {}
+    times = {}
+    added = 0
+
+    # Leave straight away, or wait at the start while it is not reserved
+    for waits in range(int(settings.SPACETIME_MAX_WAIT / step) + 1):
+        depart = now + waits * step
+
+        if waits and overlaps(reserved_markers.get(start, []), now, depart):
+            break
+
+        state = (start, round(depart / step))
+        parents[state] = None
+        times[state] = depart
+
+        heapq.heappush(queue, (depart + hops[start] * fastest, added, start, depart))
+        added += 1
+
+    while queue:
+        _, _, current, arrive = heapq.heappop(queue)
+
+        if current == finish or arrive > horizon:
+            # Continue past the horizon without reservations
+            rest = [current] if current == finish else \
+                planner.route(current, finish, doors_state, shortcuts)
+
+            if rest is None:
+                continue
+
+            route = []
+            state = (current, round(arrive / step))
+
+            while state is not None:
+                route.append(state[0])
+                depart = times[state]
+                state = parents[state]
+
+            return route[::-1] + rest[1:], depart
+
+        for index in range(indptr[current], indptr[current + 1]):
+            point = int(indices[index])
+
+            if not allowed[index] or hops[point] == -1:
+                continue
+
+            then = arrive + travel_time(current, point)
+
+            # Skip markers and routes the Alien will be near
+            if overlaps(reserved_markers.get(point, []), then, then) or \
+                    overlaps(reserved_routes.get((current, point), []), arrive, then):
+                continue
+
+            state = (point, round(then / step))
+
+            if state in parents:
+                continue
+
+            parents[state] = (current, round(arrive / step))
+            times[state] = then
+
+            heapq.heappush(
+                queue, (then + hops[point] * fastest, added, point, then))
+            added += 1
+
+    return None, now
+
+
+class incremental:
+    """
+    D* Lite planner for one robot, searching back from the finish so the start can move.
+    The search is kept between calls; only markers affected by blocked or reopened routes are searched again.
+    """
+
+    def __init__(self, graph, positions=None, shortcuts=False):
+        # Whether the graph is the Alien's, with shortcuts through the vents
+        self.shortcuts = shortcuts
+
+        # Edge costs are the distance between markers if known, otherwise one per marker
+        self.positions = positions
+
+        self.successors = [list(points) for points in graph]
+        self.predecessors = [[] for _ in graph]
+
+        for code, points in enumerate(graph):
+            for point in points:
+                self.predecessors[point].append(code)
+
+        # Routes currently blocked, as (from, to) pairs
+        self.blocked = set()
+
+        self.finish = None
+
+    def distance(self, a, b):
+        # Markers with no allowed routes have no position
+        if self.positions is None or a not in self.positions or b not in self.positions:
+            return 0
+
+        return math.hypot(self.positions[a][0] - self.positions[b][0],
+                          self.positions[a][1] - self.positions[b][1])
+
+    def cost(self, a, b):
+        if (a, b) in self.blocked:
+            return math.inf
+
+        if self.positions is None:
+            return 1
+
+        return self.distance(a, b)
+
+    def key(self, code):
+        best = min(self.g[code], self.rhs[code])
+        return (best + self.distance(self.start, code) + self.km, best)
+
+    def reset(self, start, finish):
+        """
+        Start a new search towards `finish`.
+        """
+        self.start = self.last_start = start
+        self.finish = finish
+        self.km = 0
+
+        self.g = [math.inf] * len(self.successors)
+        self.rhs = [math.inf] * len(self.successors)
+        self.rhs[finish] = 0
+
+        # Queue of (key, order added, marker); entries are only valid while `queued` holds the same key
+        self.queue = []
+        self.queued = {}
+        self.added = 0
+
+        self.push(finish)
+
+    def push(self, code):
+        key = self.key(code)
+        self.queued[code] = key
+
+        heapq.heappush(self.queue, (key, self.added, code))
+        self.added += 1
+
+    def top(self):
+        """
+        Returns the smallest valid key in the queue, discarding outdated entries.
+        """
+        while self.queue:
+            key, _, code = self.queue[0]
+
+            if self.queued.get(code) == key:
+                return key
+
+            heapq.heappop(self.queue)
+
+        return (math.inf, math.inf)
+
+    def update(self, code):
+        """
+        Recalculate the cost to the finish from a marker, queueing it if inconsistent.
+        """
+        if code != self.finish:
+            self.rhs[code] = min([self.cost(code, point) + self.g[point]
+                                  for point in self.successors[code]], default=math.inf)
+
+        self.queued.pop(code, None)
+
+        if self.g[code] != self.rhs[code]:
+            self.push(code)
+
+    def search(self):
+        """
+        Expand markers until the cost from the start is known.
+        """
+        while self.top() < self.key(self.start) or self.rhs[self.start] != self.g[self.start]:
+            if not self.queue:
+                break
+
+            old_key, _, code = heapq.heappop(self.queue)
+            del self.queued[code]
+
+            new_key = self.key(code)
+
+            if old_key < new_key:
+                self.push(code)
+
+            elif self.g[code] > self.rhs[code]:
+                self.g[code] = self.rhs[code]
+
+                for point in self.predecessors[code]:
+                    self.update(point)
+
+            else:
+                self.g[code] = math.inf
+
+                for point in [*self.predecessors[code], code]:
+                    self.update(point)
+
+    def route(self, start, finish, blocked):
+        """
+        Finds the shortest route from the current position of the robot, with `blocked` routes removed.
+
+        @returns:
+        List of markers from `start` to `finish`, or None if there is no route
+        """
+        if start == finish:
+            return None
+
+        if finish != self.finish:
+            self.blocked = set(blocked)
+            self.reset(start, finish)
+
+        else:
+            # Keys are offset as the start moves, instead of requeueing every marker
+            self.km += self.distance(self.last_start, start)
+            self.start = self.last_start = start
+
+            changed = self.blocked ^ set(blocked)
+            self.blocked = set(blocked)
+
+            for point, _ in changed:
+                self.update(point)
+
+        self.search()
+
+        if self.g[start] == math.inf:
+            return None
+
+        # Follow the cheapest next marker, in the order markers are listed when tied
+        route = [start]
+
+        while route[-1] != finish and len(route) <= len(self.successors):
+            current = route[-1]
+
+            route.append(min(self.successors[current],
+                             key=lambda point: self.cost(current, point) + self.g[point]))
+
+        if route[-1] != finish:
+            log.error(f"Incremental route from {start} to {finish} is invalid")
+            return None
+
+        return route
+
+
+class planner:
+    """
+    Searches of the Engineer and Alien graphs of a map, for each combination of closed doors.
+    Searches which avoid a marker are calculated the first time they are needed, then kept.
+    Distance weighted routes are kept until any marker moves by more than `tolerance`.
+    """
+
+    def __init__(self, compound_map, tolerance=0):
+        self.map = compound_map
+
+        self.graphs = {
+            False: compound_map.routes,
+            True: compound_map.routes_alien
+        }
+        self.markers_doors = compound_map.doors
+
+        # CSR arrays of each graph, and the marker each route starts from
+        self.csr = {}
+
+        for shortcuts, (indptr, indices) in compound_map.csr.items():
+            sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            self.csr[shortcuts] = (indptr, indices, sources)
+
+        # Allowed routes keyed by (shortcuts, closed doors, avoid)
+        self.masks = {}
+
+        # Searches keyed by (shortcuts, closed doors, avoid, finish)
+        self.searches = {}
+        self.lock = threading.Lock()
+
+        # Distance weighted routes keyed by (shortcuts, closed doors, avoid, start, finish)
+        self.routes = {}
+        self.tolerance = tolerance
+
+        # Marker positions the distance weighted routes were found with
+        self.positions = None
+
+        # Markers which can be travelled to or from
+        self.points = sorted({point for graph in self.graphs.values()
+                              for code, points in enumerate(graph) if points
+                              for point in [code, *points]})
+
+        # Searches calculated ahead are never forgotten
+        self.precomputed = math.inf
+
+        # Calculate searches to every marker with every combination of closed doors ahead on small maps
+        combinations = 2 ** len(self.markers_doors) * \
+            len(self.points) * len(self.graphs)
+
+        if combinations <= settings.ROUTE_PRECOMPUTE_LIMIT:
+            for shortcuts in self.graphs:
+                for count in range(len(self.markers_doors) + 1):
+                    for closed in itertools.combinations(range(len(self.markers_doors)), count):
+                        for finish in self.points:
+                            self.search(shortcuts, closed, None, finish)
+
+            log.debug(f"Route searches calculated: {len(self.searches)}")
+
+        self.precomputed = len(self.searches)
+
+    def mask(self, shortcuts, closed, avoid):
+        """
+        Returns which routes of a graph are allowed with the closed doors and avoided marker removed.
+        """
+        key = (shortcuts, closed, avoid)
+
+        if key not in self.masks:
+            _, indices, sources = self.csr[shortcuts]
+            allowed = np.ones(len(indices), dtype=bool)
+
+            # Remove route through the door
+            for index in closed:
+                door = self.markers_doors[index]
+                allowed &= ~(np.isin(sources, door) & np.isin(indices, door))
+
+            if avoid is not None:
+                allowed &= (indices != avoid) & (sources != avoid)
+
+            self.masks[key] = allowed
+
+        return self.masks[key]
+
+    def search(self, shortcuts, closed, avoid, finish):
+        """
+        Returns the number of markers to `finish` from every marker, searching if needed.
+        """
+        key = (shortcuts, closed, avoid, finish)
+
+        with self.lock:
+            if key not in self.searches:
+                # Forget the oldest search once too many are kept
+                if len(self.searches) >= self.precomputed + settings.ROUTE_CACHE_SIZE:
+                    del self.searches[next(itertools.islice(
+                        self.searches, self.precomputed, None))]
+
+                indptr, indices, sources = self.csr[shortcuts]
+
+                self.searches[key] = hops_to(indptr, indices, sources,
+                                             self.mask(shortcuts, closed, avoid), finish)
+
+            return self.searches[key]
+
+    def blocked(self, start, doors_state, shortcuts=False, avoid=None):
+        """
+        Returns the routes which can't be travelled from `start`, as (from, to) pairs.
+        Closed doors only block the route if `start` is next to the door.
+        """
+        graph = self.graphs[shortcuts]
+        blocked = set()
+
+        for index, door in enumerate(self.markers_doors):
+            if not doors_state[index] and start in door:
+                blocked.update((a, b) for a in door for b in door if b in graph[a])
+
+        # The avoided marker can always be left
+        if avoid is not None and avoid != start:
+            blocked.update((code, avoid) for code, points in enumerate(graph) if avoid in points)
+
+        return blocked
+
+    def session(self, shortcuts=False):
+        """
+        Returns an incremental planner for one robot, using the latest known marker positions.
+        """
+        positions = None
+
+        with self.lock:
+            if self.positions is not None:
+                positions = {point: self.positions[point].tolist()
+                             for point in self.points}
+
+        return incremental(self.graphs[shortcuts], positions, shortcuts)
+
+    def update_positions(self, positions):
+        """
+        Save the latest marker positions if the positions of all markers in the graphs are known,
+        forgetting distance weighted routes if any marker has moved by more than the tolerance.
+
+        @returns:
+        True if positions are known to weight routes by, either these or the last complete positions
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+
+        with self.lock:
+            if np.isnan(positions[self.points]).any():
+                return self.positions is not None
+
+            if self.positions is None or \
+                    np.abs(positions[self.points] - self.positions[self.points]).max() > self.tolerance:
+                if self.positions is not None:
+                    log.debug("Marker positions changed, recalculating routes")
+
+                self.positions = positions
+                self.routes = {}
+
+        return True
+
+    def route(self, start, finish, doors_state, shortcuts=False, avoid=None, positions=None):
+        """
+        Finds the shortest route between two markers.
+        Closed doors only block the route if `start` is next to the door.
+        If `positions` are given, the route with the shortest distance is found and kept until the markers move,
+        otherwise the route with the fewest markers is looked up from the searches.
+
+        @returns:
+        List of markers from `start` to `finish`, or None if there is no route
+        """
+        # A route can't return to where it started
+        if start == finish or finish == avoid:
+            return None
+
+        # The avoided marker can always be left
+        if avoid == start:
+            avoid = None
+
+        closed = tuple(index for index, door in enumerate(self.markers_doors)
+                       if not doors_state[index] and start in door)
+
+        if positions is not None:
+            if self.update_positions(positions):
+                return self.distance_route(start, finish, doors_state, shortcuts, closed, avoid)
+
+            log.debug("Marker positions unknown, routing by fewest markers")
+
+        hops = self.search(shortcuts, closed, avoid, finish)
+
+        if hops[start] == -1:
+            return None
+
+        indptr, indices, _ = self.csr[shortcuts]
+        allowed = self.mask(shortcuts, closed, avoid)
+
+        route = [start]
+
+        # Take the first allowed next marker which is one closer to the finish
+        while route[-1] != finish:
+            current = route[-1]
+
+            for index in range(indptr[current], indptr[current + 1]):
+                point = indices[index]
+
+                if allowed[index] and hops[point] == hops[current] - 1:
+                    route.append(int(point))
+                    break
+
+        return route
+
+    def distance_route(self, start, finish, doors_state, shortcuts, closed, avoid):
+        """
+        Returns the shortest route by distance, finding it if needed.
+        """
+        key = (shortcuts, closed, avoid, start, finish)
+
+        with self.lock:
+            if key in self.routes:
+                route = self.routes[key]
+                return None if route is None else list(route)
+
+            geometry = self.positions
+
+        # Searched by a planner of its own, so robots' sessions are unaffected
+        positions = {point: geometry[point].tolist() for point in self.points}
+
+        route = incremental(self.graphs[shortcuts], positions, shortcuts).route(
+            start, finish, self.blocked(start, doors_state, shortcuts, avoid))
+
+        with self.lock:
+            # Only keep the route if the markers have not moved while searching
+            if self.positions is geometry:
+                # Forget the oldest route once too many are kept
+                if len(self.routes) >= settings.ROUTE_CACHE_SIZE:
+                    del self.routes[next(iter(self.routes))]
+
+                self.routes[key] = route
+
+        return None if route is None else list(route)
@@ -10,6 +10,130 @@ Mechatronics 2
 # Camera framerate in FPS
 FRAMERATE = 20
 
+# Adapt the camera framerate to the robots; FRAMERATE is used while a robot is moving
+GOVERNOR = True
+
+# Camera framerate when the robots are stopped, and when a robot is near its next marker
+FRAMERATE_IDLE = 5
+FRAMERATE_MAX = 30
+
+# Seconds between framerate recalculations
+GOVERNOR_INTERVAL = 0.5
+
+# Radius within which a robot is near its next marker, and the maximum framerate is used
+GOVERNOR_NEAR_RADIUS = 30
+
+# Maximum framerate of the live video feed sent to each viewer in FPS
+VIEWER_FRAMERATE = 10
+
+# Seconds to wait for the IP camera before giving up on a request
+CAM_TIMEOUT = 5
+
+# Bytes read from an MJPEG stream at a time
+CAM_CHUNK_SIZE = 4096
+
+# Number of frames held between vision pipeline stages; older frames are dropped
+PIPELINE_BUFFER_SIZE = 2
+
+# Seconds a pipeline stage waits for a frame before checking if it should stop
+PIPELINE_TIMEOUT = 0.5
+
+# Seconds between vision pipeline statistics reports
+PIPELINE_STATS_INTERVAL = 5
+
+# Record the latency from frame capture to each stage of the control loop, reported with the pipeline statistics
+TRACING = True
+
+# Number of recent latencies kept for each stage
+TRACE_SAMPLES = 1000
+
+# Only search around the last known position of each marker between full frame scans
+# Off by default; on the benchmark scenes it is no faster than scanning the full frame
+TRACKING = False
+
+# Frames between full frame scans when tracking markers
+TRACKING_SCAN_INTERVAL = 10
+
+# Padding around a tracked marker to search, as a fraction of the marker size
+TRACKING_MARGIN = 0.75
+
+# Minimum padding around a tracked marker to search in pixels
+TRACKING_MIN_MARGIN = 20
+
+# Detect markers on a grayscale image reduced by this factor (1, 2, 4 or 8); 1 uses full resolution
+DETECTION_SCALE = 1
+
+# Half size in pixels of the window used to refine marker corners at full resolution
+SUBPIX_WINDOW = 5
+
+# How marker positions are calculated from the camera image:
+# "pose" - 3D pose estimation of every marker, in aruco units
+# "floor" - Floor homography from the fixed compound markers, in millimetres
+DETECTION_MODE = "pose"
+
+# Surveyed centres [x, y] in mm of the fixed compound markers used to calibrate the floor
+# The first marker sets the direction of the floor axes
+FLOOR_MARKERS = {
+    2: (0, 0)   # Entrance
+}
+
+# Side length in mm of the fixed compound markers
+FLOOR_MARKER_SIZE = 70
+
+# Number of worker processes used for marker detection for each camera; 0 detects in the main process
+DETECTION_WORKERS = 0
+
+# Bytes of shared memory used to pass frames to each worker process, large enough for one raw frame
+WORKER_BUFFER_SIZE = 1920 * 1080 * 3
+
+# Seconds to wait for a worker process to detect markers in a frame
+WORKER_TIMEOUT = 2
+
+# Seconds a camera's latest detections may be older than the newest camera's and still be fused
+FUSION_MAX_AGE = 0.2
+
+# Samples of each marker's position kept in its history; 60 seconds at the maximum framerate
+HISTORY_LENGTH = 1800
+
+# Seconds of history used to estimate the velocity of a marker
+HISTORY_VELOCITY_WINDOW = 1
+
+# Compound map file in mars/maps; may be overridden by the MAP environment variable
+MAP = "compound"
+
+# Route searches to calculate ahead for every combination of closed doors; larger maps search when needed
+ROUTE_PRECOMPUTE_LIMIT = 10000
+
+# Route searches and distance weighted routes kept once calculated, in addition to searches calculated ahead
+ROUTE_CACHE_SIZE = 4096
+
+# Route weighting; "distance" for the shortest distance between markers, "hops" for the fewest markers
+ROUTE_WEIGHTING = "distance"
+
+# Distance any compound marker must move before distance weighted routes are recalculated, in aruco units
+ROUTE_GEOMETRY_TOLERANCE = 5
+
+# Plan the Engineer's route around where the Alien is predicted to be, while the Alien is active
+SPACETIME = True
+
+# Expected speed of the Engineer and Alien in aruco units per second, until their speed has been measured
+ENGINEER_SPEED = 30
+ALIEN_SPEED = 30
+
+# Seconds of marker history used to measure the speed of the robots
+SPACETIME_SPEED_WINDOW = 10
+
+# Seconds to travel to a marker which hasn't been seen
+SPACETIME_HOP_TIME = 3
+
+# Seconds before and after the Alien is predicted to be near a marker that the marker is avoided
+SPACETIME_MARGIN = 2
+
+# Time step of the space-time planner, longest the Engineer may wait for the Alien to pass, and how far ahead to plan, in seconds
+SPACETIME_STEP = 0.5
+SPACETIME_MAX_WAIT = 10
+SPACETIME_HORIZON = 60
+
 # General data transmission rate for UI
 DATARATE = 1
 
@@ -26,8 +150,43 @@ MARKER_RADIUS_ENGINEER = 10
 # Forward rate for engineer
 FORWARD_RATE = 0.5
 
-# How much aruco positions can change with each update; 1 is 100% the new value
-MARKER_SMOOTHING = 0.3
+# Name of the shared memory block holding the latest marker positions, and the number of aruco ids it holds
+MARKER_TABLE_NAME = "mars_markers"
+MARKER_TABLE_SIZE = 50
+
+# Also save marker positions to the Redis database; only needed by readers outside the Python system
+MARKER_REDIS_MIRROR = True
+
+# Redis hash holding a binary record of each marker's position, see markers.RECORD
+MARKER_REDIS_KEY = "markers"
+
+# Change in position (aruco units) and yaw (radians) below which a marker is not written to Redis again
+MARKER_DEADBAND = 0.5
+MARKER_YAW_DEADBAND = 0.02
+
+# Seconds after which a marker's record is rewritten even if it has not moved
+MARKER_MIRROR_INTERVAL = 1
+
+# Marker tracker measurement noise; standard deviation of detected position (aruco units) and yaw (radians)
+TRACKER_POSITION_NOISE = 0.5
+TRACKER_YAW_NOISE = 0.05
+
+# Marker tracker process noise; standard deviation of acceleration (aruco units/s^2) and yaw acceleration (radians/s^2)
+TRACKER_ACCEL_NOISE = 20
+TRACKER_YAW_ACCEL_NOISE = 5
+
+# Expected speed (aruco units/s) and yaw rate (radians/s) of a newly detected marker
+TRACKER_INITIAL_SPEED = 20
+TRACKER_INITIAL_YAW_RATE = 2
+
+# Squared Mahalanobis distance above which a detection is rejected as an outlier
+TRACKER_GATE = 16
+
+# Consecutive rejected detections before a marker is assumed to have really moved
+TRACKER_MAX_REJECTED = 3
+
+# Seconds without a detection before a marker is stale; robots stop rather than steer by stale positions
+TRACKER_STALE_TIME = 0.5
 
 # General variables for communications
 TEAM_NAME = "ALIEN_SELF_ISOLATION"
@@ -69,5 +228,5 @@ COMPOUND_MESSAGES = {
 }
 
 # Unit conversion for Engineer
-DIST_MULTIPLIER = 0.6           # Convert from aruco units to mm
+DIST_MULTIPLIER = 0.6           # Convert from aruco units to mm, not required in "floor" detection mode
 MAX_DISTANCE = 300
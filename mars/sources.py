@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+sources.py
+Persistent frame sources for the vision system, keeping a single connection to the camera open between frames.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import os
+import time
+
+import cv2
+import numpy as np
+import requests
+
+from mars import logs, recorder, settings
+
+log = logs.create_log(__name__)
+
+# JPEG start and end of image markers
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+
+
+def decode(jpeg, flags=cv2.IMREAD_COLOR):
+    """
+    Convert raw JPEG bytes to an openCV compatible image.
+    """
+    if not jpeg:
+        return None
+
+    return cv2.imdecode(np.frombuffer(jpeg, dtype="uint8"), flags)
+
+
+class snapshot_session:
+    """
+    Requests single JPEG snapshots from an IP camera, reusing one keep-alive HTTP session between frames.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def read_raw(self):
+        """
+        Returns the latest frame as raw JPEG bytes.
+        """
+        try:
+            resp = self.session.get(self.url, timeout=settings.CAM_TIMEOUT)
+        except Exception as e:
+            log.exception(
+                "Unexpected error code when connecting to IP camera!")
+            raise
+
+        return resp.content
+
+    def read(self):
+        """
+        Returns the latest frame as an openCV compatible image.
+        """
+        return decode(self.read_raw())
+
+    def close(self):
+        self.session.close()
+
+
+class mjpeg_stream:
+    """
+    Reads frames from a long-lived multipart MJPEG stream.
+    Frames are split by searching for JPEG start and end markers, so the boundary string is not required.
+    """
+
+    # The camera pushes frames at its own rate; the stream must be read continuously or frames queue up in the socket
+    paced = True
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        self.resp = None
+        self.buffer = bytearray()
+
+    def connect(self):
+        """
+        Opens the stream, retrying up to the connection attempt limit.
+        """
+        self.close()
+
+        for attempt in range(settings.CONNECTION_ATTEMPTS_LIMIT):
+            try:
+                self.resp = self.session.get(
+                    self.url, stream=True, timeout=settings.CAM_TIMEOUT)
+                self.resp.raise_for_status()
+                return
+
+            except Exception as e:
+                log.warning(
+                    f"Unable to open MJPEG stream (attempt {attempt + 1}): {e}")
+
+        log.error("Unable to connect to MJPEG stream!")
+        raise ConnectionError(f"Unable to open MJPEG stream: {self.url}")
+
+    def read_raw(self):
+        """
+        Returns the next complete frame in the stream as raw JPEG bytes.
+        """
+        if self.resp is None:
+            self.connect()
+
+        while True:
+            start = self.buffer.find(JPEG_SOI)
+            end = self.buffer.find(JPEG_EOI, start + 2) if start != -1 else -1
+
+            # A complete frame is available
+            if end != -1:
+                jpeg = bytes(self.buffer[start:end + 2])
+                del self.buffer[:end + 2]
+                return jpeg
+
+            # Discard any bytes before the start of the next frame
+            if start > 0:
+                del self.buffer[:start]
+
+            try:
+                chunk = self.resp.raw.read(settings.CAM_CHUNK_SIZE)
+            except Exception as e:
+                log.warning(f"MJPEG stream interrupted, reconnecting: {e}")
+                chunk = b''
+
+            # Stream has closed, reopen it and start again
+            if not chunk:
+                self.connect()
+                continue
+
+            self.buffer.extend(chunk)
+
+    def read(self):
+        """
+        Returns the next frame as an openCV compatible image.
+        """
+        return decode(self.read_raw())
+
+    def close(self):
+        if self.resp is not None:
+            self.resp.close()
+            self.resp = None
+
+        self.buffer.clear()
+
+
+class capture_device:
+    """
+    Keeps a local (USB) camera open for the lifetime of the source.
+    """
+
+    # Reads wait for the next frame from the camera, which buffers frames which are not read
+    paced = True
+
+    def __init__(self, index=0):
+        self.index = index
+        self.capture = None
+
+    def read(self):
+        """
+        Returns the latest frame as an openCV compatible image.
+        """
+        if self.capture is None:
+            self.capture = cv2.VideoCapture(self.index)
+
+            if not self.capture.isOpened():
+                self.capture = None
+                log.error("Unable to connect to physical camera!")
+                raise ConnectionError(
+                    f"Unable to open capture device: {self.index}")
+
+        ok, frame = self.capture.read()
+
+        if not ok:
+            log.warning("Physical camera returned no frame")
+            return None
+
+        return frame
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+class replay:
+    """
+    Plays back a recording made by `recorder.recorder`.
+    Frames are returned at the rate they were recorded if `realtime` is True, otherwise as fast as possible.
+    """
+
+    # Frames are returned at the recorded rate, so no extra framerate sync is required
+    paced = True
+
+    def __init__(self, path, realtime=True, loop=False):
+        self.recording = recorder.recording(path)
+        self.realtime = realtime
+        self.loop = loop
+
+        self.position = 0
+        self.start_time = None
+
+        log.info(f"Replaying {len(self.recording)} frames from: {path}")
+
+    def read_raw(self):
+        """
+        Returns the next recorded frame as raw JPEG bytes, or None when the recording has finished.
+        """
+        if self.position >= len(self.recording):
+            if not self.loop or not len(self.recording):
+                # Avoid spinning while the pipeline waits for frames
+                time.sleep(settings.PIPELINE_TIMEOUT)
+                return None
+
+            self.position = 0
+            self.start_time = None
+
+        timestamp, jpeg = self.recording.frame(self.position)
+
+        if self.realtime:
+            # Line up the first frame of the recording with the current time
+            if self.start_time is None:
+                self.start_time = time.time() - timestamp
+
+            time_remain = self.start_time + timestamp - time.time()
+
+            if time_remain > 0:
+                time.sleep(time_remain)
+
+        self.position += 1
+
+        return jpeg
+
+    def read(self):
+        """
+        Returns the next recorded frame as an openCV compatible image.
+        """
+        return decode(self.read_raw())
+
+    def close(self):
+        self.recording.close()
+
+
+def env_list(name):
+    """
+    Returns a comma separated environment variable as a list, with one entry per camera.
+    """
+    return [item.strip() for item in (os.environ.get(name) or "").split(",") if item.strip()]
+
+
+def camera_count():
+    """
+    Returns the number of cameras listed in the environment.
+    """
+    if os.environ.get("CAM_REPLAY"):
+        return len(env_list("CAM_REPLAY"))
+
+    if os.environ.get("REAL_CAM"):
+        return max(len(env_list("CAM_DEVICE")), 1)
+
+    return max(len(env_list("CAM_IP")), 1)
+
+
+def create_source(url, number=0):
+    """
+    Create the frame source selected by the environment, for camera `number`.
+
+    `CAM_REPLAY` replays a recording from file, as fast as possible if `CAM_REPLAY_FAST` is set.
+    `REAL_CAM` selects a local capture device, otherwise `CAM_MODE` selects
+    between "snapshot" (default) and "mjpeg" for the IP camera at `url`.
+    """
+    if os.environ.get("CAM_REPLAY"):
+        return replay(env_list("CAM_REPLAY")[number],
+                      realtime=not os.environ.get("CAM_REPLAY_FAST"),
+                      loop=bool(os.environ.get("CAM_REPLAY_LOOP")))
+
+    if os.environ.get("REAL_CAM"):
+        devices = env_list("CAM_DEVICE") or ["0"]
+        return capture_device(int(devices[number]))
+
+    mode = os.environ.get("CAM_MODE") or "snapshot"
+
+    if mode == "mjpeg":
+        return mjpeg_stream(url)
+
+    if mode != "snapshot":
+        log.warning(f"Unknown camera mode: {mode}, using snapshots")
+
+    return snapshot_session(url)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+trace.py
+Lightweight latency tracing from camera frame capture to robot commands.
+
+Every frame is stamped with its capture time. Each hop records a span with the age of the
+newest data it is working on, so the report shows where the control loop loses time:
+    detect  - Markers detected in a frame
+    update  - Marker positions saved
+    vector  - Vector calculated between two markers by the logic
+    publish - Command published to a robot, i.e. capture to actuation
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+# Recent latencies in seconds for each hop
+spans = {}
+lock = threading.Lock()
+
+
+def span(hop, capture_time):
+    """
+    Record the latency of a hop, for data captured at `capture_time`.
+    """
+    if not settings.TRACING or capture_time is None:
+        return
+
+    latency = time.time() - capture_time
+
+    with lock:
+        if hop not in spans:
+            spans[hop] = deque(maxlen=settings.TRACE_SAMPLES)
+
+        spans[hop].append(latency)
+
+
+def report():
+    """
+    Returns the latency distribution of every hop in milliseconds.
+    """
+    with lock:
+        latencies = {hop: np.array(samples) * 1000 for hop, samples in spans.items() if samples}
+
+    return {
+        hop: {
+            "count": len(ms),
+            "p50_ms": round(float(np.percentile(ms, 50)), 1),
+            "p95_ms": round(float(np.percentile(ms, 95)), 1),
+            "p99_ms": round(float(np.percentile(ms, 99)), 1),
+            "max_ms": round(float(ms.max()), 1)
+        }
+        for hop, ms in latencies.items()
+    }
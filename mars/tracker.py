@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+tracker.py
+Constant velocity Kalman filters used to track every aruco marker between frames.
+
+Position is tracked as [x, y, x velocity, y velocity], and yaw separately as [yaw, yaw rate] with
+angles wrapped to +/- pi. Measurements far outside the predicted position (by Mahalanobis distance)
+are rejected, so a single bad detection cannot throw a robot off course.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import threading
+
+import numpy as np
+
+from mars import logs, markers, settings
+
+log = logs.create_log(__name__)
+
+# Tracks of every marker, kept by the process which saves marker positions
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    """
+    Returns the marker tracker for this process, creating it if needed.
+    """
+    global _tracker
+
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = tracker()
+
+        return _tracker
+
+
+def wrap(angle):
+    """
+    Wraps angles in radians to +/- pi.
+    """
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def transition(dt):
+    """
+    Returns the constant velocity state transition and process noise matrices for one axis,
+    for each time step in `dt`, using a white noise acceleration model.
+    """
+    ones = np.ones_like(dt)
+    zeros = np.zeros_like(dt)
+
+    F = np.stack([np.stack([ones, dt], -1), np.stack([zeros, ones], -1)], -2)
+
+    Q = np.stack([np.stack([dt**4 / 4, dt**3 / 2], -1),
+                  np.stack([dt**3 / 2, dt**2], -1)], -2)
+
+    return F, Q
+
+
+class tracker:
+    """
+    Kalman filters for every aruco id, updated in batches of markers detected in the same frame.
+    """
+
+    def __init__(self, size=None):
+        from mars import coords
+
+        size = size or markers.table_size()
+
+        # Noise settings are in aruco units
+        self.scale = coords.scale_distance(1)
+
+        self.position_noise = (settings.TRACKER_POSITION_NOISE * self.scale) ** 2
+        self.accel_noise = (settings.TRACKER_ACCEL_NOISE * self.scale) ** 2
+        self.yaw_noise = settings.TRACKER_YAW_NOISE ** 2
+        self.yaw_accel_noise = settings.TRACKER_YAW_ACCEL_NOISE ** 2
+
+        # Position state is [x, vx] and [y, vy], sharing one covariance as both axes are independent and equal
+        self.position = np.zeros((size, 2, 2))
+        self.position_covariance = np.zeros((size, 2, 2))
+
+        # Yaw state is [yaw, yaw rate]
+        self.yaw = np.zeros((size, 2))
+        self.yaw_covariance = np.zeros((size, 2, 2))
+
+        # Time of the latest measurement of each marker
+        self.time = np.zeros(size)
+        self.initialised = np.zeros(size, dtype=bool)
+
+        # Consecutive rejected measurements of each marker
+        self.rejected = np.zeros(size, dtype=int)
+
+    def reset(self, ids, positions, yaws):
+        """
+        Start tracking markers from a measurement, with unknown velocity.
+        """
+        self.position[ids] = 0
+        self.position[ids, :, 0] = positions
+
+        self.yaw[ids] = 0
+        self.yaw[ids, 0] = yaws
+
+        self.position_covariance[ids] = np.diag(
+            [self.position_noise, (settings.TRACKER_INITIAL_SPEED * self.scale)**2])
+        self.yaw_covariance[ids] = np.diag(
+            [self.yaw_noise, settings.TRACKER_INITIAL_YAW_RATE**2])
+
+        self.initialised[ids] = True
+        self.rejected[ids] = 0
+
+    def update(self, ids, positions, yaws, timestamp):
+        """
+        Update the tracks of markers detected in the same frame.
+
+        @returns:
+        positions - Filtered [x, y] of each marker
+        velocities - Estimated [x, y] velocity of each marker, per second
+        yaws - Filtered yaw of each marker
+        yaw_rates - Estimated yaw rate of each marker, in radians per second
+        times - Time of the latest measurement used by each track
+        """
+        ids = np.asarray(ids, dtype=int)
+        positions = np.asarray(positions, dtype=np.float64)
+        yaws = np.asarray(yaws, dtype=np.float64)
+
+        dt = timestamp - self.time[ids]
+
+        # New markers and markers lost for too long start again from the measurement
+        restart = ~self.initialised[ids] | (dt > settings.TRACKER_STALE_TIME)
+
+        if restart.any():
+            self.reset(ids[restart], positions[restart], yaws[restart])
+
+        # Measurements older than the track (e.g. from a slower camera) are not used
+        use = ~restart & (dt > 0)
+
+        if use.any():
+            use[use] = self.correct(ids[use], positions[use], yaws[use], dt[use])
+
+        # Rejected measurements don't count as seeing the marker, so it can still go stale
+        self.time[ids[restart | use]] = timestamp
+
+        return (self.position[ids, :, 0], self.position[ids, :, 1],
+                self.yaw[ids, 0], self.yaw[ids, 1], self.time[ids])
+
+    def correct(self, ids, positions, yaws, dt):
+        """
+        Predict tracks forward to the time of the measurement, then correct them with it.
+        Tracks whose measurement is rejected are left unchanged.
+
+        @returns:
+        Which tracks used the measurement, including those started again from it
+        """
+        F, Q = transition(dt)
+        Ft = np.swapaxes(F, -1, -2)
+
+        # --- Position
+        # Predict
+        x = np.einsum("nij,nkj->nki", F, self.position[ids])
+        P = F @ self.position_covariance[ids] @ Ft + \
+            Q * self.accel_noise
+
+        # Innovation, with H = [1, 0] for each axis
+        innovation = positions - x[:, :, 0]
+        S = P[:, 0, 0] + self.position_noise
+
+        # Reject measurements outside the gate
+        distance = (innovation**2).sum(axis=1) / S
+        accept = distance < settings.TRACKER_GATE
+
+        K = P[:, :, 0] / S[:, None]
+
+        x = x + accept[:, None, None] * \
+            K[:, None, :] * innovation[:, :, None]
+        P = P - accept[:, None, None] * \
+            np.einsum("ni,nj->nij", K, P[:, 0, :])
+
+        self.position[ids[accept]] = x[accept]
+        self.position_covariance[ids[accept]] = P[accept]
+
+        # --- Yaw
+        # Predict
+        y = np.einsum("nij,nj->ni", F, self.yaw[ids])
+        Py = F @ self.yaw_covariance[ids] @ Ft + Q * self.yaw_accel_noise
+
+        # Innovation taken the short way round the circle
+        innovation = wrap(yaws - y[:, 0])
+        S = Py[:, 0, 0] + self.yaw_noise
+
+        accept_yaw = accept & (innovation**2 / S < settings.TRACKER_GATE)
+
+        K = Py[:, :, 0] / S[:, None]
+
+        y = y + accept_yaw[:, None] * K * innovation[:, None]
+        y[:, 0] = wrap(y[:, 0])
+        Py = Py - accept_yaw[:, None, None] * \
+            np.einsum("ni,nj->nij", K, Py[:, 0, :])
+
+        self.yaw[ids[accept]] = y[accept]
+        self.yaw_covariance[ids[accept]] = Py[accept]
+
+        # A marker which really has moved keeps being rejected; start again from the measurement
+        self.rejected[ids] = np.where(accept, 0, self.rejected[ids] + 1)
+        lost = self.rejected[ids] > settings.TRACKER_MAX_REJECTED
+
+        if (~accept).any():
+            log.debug(f"Rejected marker measurements: {ids[~accept].tolist()}")
+
+        if lost.any():
+            self.reset(ids[lost], positions[lost], yaws[lost])
+
+        return accept | lost
@@ -8,14 +8,14 @@ Mechatronics 2
 """
 
 import logging
+import math
 import threading
-import time
 
 import redis
-from flask import Flask, Response, render_template
+from flask import Flask, Response, jsonify, render_template, request
 from flask_socketio import SocketIO
 
-from mars import cam, comms, coords, logic, logs, settings
+from mars import comms, coords, fusion, history, logic, logs
 
 # --- INITIALISATION ---
 log = logs.create_log(__name__)
@@ -24,7 +24,7 @@ app = Flask(__name__)
 sio = SocketIO(app, async_mode='threading', log=None)
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
-cam = cam.camera()
+cam = fusion.rig()
 
 r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
 
@@ -55,24 +55,46 @@ def index():
 def video_feed():
     """
     Return the response generated along with the specific media type (mime type)
+    Use `?camera=N` to select which camera to watch.
     """
+    feed = cam.video_feed(request.args.get("camera", 0, type=int))
 
-    # Terminate any existing video streams
-    cam.allow_stream = False
-    time.sleep(2 / settings.FRAMERATE)
-    cam.allow_stream = True
+    if feed is None:
+        return Response(status=404)
 
-    return Response(cam.video_feed(),
+    return Response(feed,
                     mimetype="multipart/x-mixed-replace; boundary=frame")
 
 
+@app.route("/history/<int:marker>")
+def marker_history(marker):
+    """
+    Return the recent trajectory and velocity of a marker for plotting.
+    Use `?seconds=S&points=P` to select how far back to go and how many samples to return.
+    """
+    h = history.get_history()
+
+    if not 0 <= marker < len(h.samples):
+        return Response(status=404)
+
+    seconds = request.args.get("seconds", 30, type=float)
+    points = request.args.get("points", 100, type=int)
+
+    if not 0 < seconds < math.inf or points < 1:
+        return Response("seconds must be positive and points at least 1", status=400)
+
+    samples = h.downsample(marker, seconds, points)
+
+    return jsonify({
+        "samples": samples.tolist(),
+        "velocity": h.velocity(marker)
+    })
+
+
 # --- WEBSOCKET ROUTES ---
 @sio.on('connect_camera')
 def connect_camera():
-    cam.allow_generate = False
-    time.sleep(2 / settings.FRAMERATE)
-    cam.allow_generate = True
-
+    # Any cameras already running are stopped and disconnected first
     cam.generate()
 
 
@@ -124,6 +146,16 @@ def toggle_doors(data):
     coords.route().doors(index, state)
 
 
+@sio.on('toggle_doors_many')
+def toggle_doors_many(data):
+    """
+    Opens or closes several doors at once, from a list of {"index", "state"}.
+    """
+    states = {door["index"]: door["state"] for door in data["doors"]}
+
+    return coords.route().set_doors(states)
+
+
 @sio.on('start_comms')
 def start_comms():
     comms.commands().start_comms()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+workers.py
+Runs marker detection in separate processes, so vision work does not compete with the webserver and logic loops.
+
+Frames are handed to each worker process through its own shared memory buffer, so pixel data is never pickled.
+Only the compact detection results (corners, ids, pose and yaw of each marker) are sent back.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from mars import logs, settings
+
+log = logs.create_log(__name__)
+
+# Detection results returned from a worker
+RESULT_KEYS = ["corners", "ids", "rvecs", "tvecs", "yaws"]
+
+
+class worker:
+    """
+    A single detection process, with a shared memory buffer used to send it frames.
+    Only one frame may be processed at a time; each request is numbered, and the buffer is not
+    written again until the result of the previous request has arrived.
+    """
+
+    def __init__(self, number, calibration):
+        # Spawn a fresh interpreter, as forking a process with running threads is unsafe
+        context = multiprocessing.get_context("spawn")
+
+        self.buffer = shared_memory.SharedMemory(
+            create=True, size=settings.WORKER_BUFFER_SIZE)
+
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+
+        # Number of the last request sent, and of the request still being processed if any
+        self.request = 0
+        self.pending = None
+
+        self.process = context.Process(
+            target=run,
+            args=(self.buffer.name, self.tasks, self.results, number, calibration),
+            daemon=True)
+        self.process.start()
+
+    def detect(self, frame):
+        """
+        Detect markers in a frame using the worker process.
+
+        @returns:
+        Dictionary of detection results, or None if the frame could not be processed
+        """
+        if not self.process.is_alive():
+            log.error("Detection worker has stopped!")
+            time.sleep(settings.WORKER_TIMEOUT)
+            return None
+
+        # The worker may still be reading the previous frame from the buffer
+        if self.pending is not None and self.wait(self.pending) is None:
+            log.warning("Detection worker still busy, skipping frame")
+            return None
+
+        self.request += 1
+
+        if frame["jpeg"] is not None:
+            length = len(frame["jpeg"])
+
+            if length > self.buffer.size:
+                log.error(f"Frame too large for worker buffer: {length} bytes")
+                return None
+
+            self.buffer.buf[:length] = frame["jpeg"]
+            self.tasks.put((self.request, "jpeg", length, None, None))
+
+        else:
+            image = frame["image"]
+
+            if image.nbytes > self.buffer.size:
+                log.error(
+                    f"Frame too large for worker buffer: {image.nbytes} bytes")
+                return None
+
+            np.ndarray(image.shape, image.dtype,
+                       buffer=self.buffer.buf)[:] = image
+            self.tasks.put((self.request, "image",
+                            image.nbytes, image.shape, image.dtype.str))
+
+        self.pending = self.request
+
+        result = self.wait(self.request)
+
+        if result is None:
+            log.error("No response from detection worker")
+            return None
+
+        result["seq"] = frame["seq"]
+
+        # Frame could not be processed
+        if "corners" not in result:
+            return None
+
+        return result
+
+    def wait(self, request):
+        """
+        Wait for the result of a request, discarding results of any earlier requests.
+
+        @returns:
+        Dictionary of detection results, or None if the worker did not respond in time
+        """
+        try:
+            while True:
+                result = self.results.get(timeout=settings.WORKER_TIMEOUT)
+
+                if result.pop("request") == request:
+                    break
+
+        except queue.Empty:
+            return None
+
+        self.pending = None
+
+        return result
+
+    def close(self):
+        """
+        Stop the worker process and release the shared memory buffer.
+        """
+        self.tasks.put(None)
+        self.process.join(timeout=settings.WORKER_TIMEOUT)
+
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.buffer.close()
+        self.buffer.unlink()
+
+
+def run(buffer_name, tasks, results, number, calibration):
+    """
+    Main loop of a worker process; detects markers in each frame written to the shared memory buffer.
+    """
+    from mars import cam
+
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+
+    camera = cam.camera(number)
+    camera.setup_detection(calibration)
+
+    while True:
+        task = tasks.get()
+
+        # Worker has been closed
+        if task is None:
+            break
+
+        request, kind, length, shape, dtype = task
+
+        # Latency is traced by the camera, not the worker
+        frame = {"camera": number, "seq": request, "time": None}
+
+        # Read the frame straight from shared memory without copying
+        if kind == "jpeg":
+            frame["jpeg"] = buffer.buf[:length]
+            frame["image"] = None
+        else:
+            frame["jpeg"] = None
+            frame["image"] = np.ndarray(shape, dtype, buffer=buffer.buf)
+
+        try:
+            frame = camera.detect(frame)
+        except Exception as e:
+            log.exception("Detection worker failed to process frame")
+            frame = None
+
+        if frame is None:
+            results.put({"request": request, "ids": None})
+        else:
+            results.put({"request": request,
+                         **{key: frame.get(key) for key in RESULT_KEYS}})
+
+        # Release all views of the shared memory before the next frame
+        del frame
+
+    buffer.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+world.py
+Snapshot of the distance and direction between every pair of markers, calculated once per camera frame.
+
+Mechatronics 2
+~ Callum Morrison, 2020
+"""
+
+import math
+
+import numpy as np
+
+from mars import logs
+
+log = logs.create_log(__name__)
+
+# Latest snapshot, replaced after every frame
+_latest = None
+
+
+def latest():
+    """
+    Returns the latest snapshot, or None if no frames have been processed.
+    """
+    return _latest
+
+
+def publish(positions, timestamp, capture_times, active=None):
+    """
+    Calculate a new snapshot from the [x, y, yaw] of every marker and make it the latest.
+    """
+    global _latest
+    _latest = snapshot(positions, timestamp, capture_times, active)
+
+
+def vectors(source, target):
+    """
+    Returns the distance and direction from [x, y, yaw] `source` positions to [x, y, yaw] `target` positions,
+    using the conventions of `coords.calculate_vector`. Arrays are broadcast against each other.
+    """
+    delta_x = target[..., 0] - source[..., 0]
+    delta_y = source[..., 1] - target[..., 1]
+
+    magnitude = np.hypot(delta_x, delta_y)
+
+    # Calculate direction to north by subtracting two angles
+    direction = -source[..., 2]
+
+    # Add extra rotation to point towards the target
+    with np.errstate(divide="ignore", invalid="ignore"):
+        direction = direction + np.where(delta_y == 0, math.pi / 2,
+                                         np.arctan(delta_x / delta_y))
+
+    # If delta_y is positive, angle correction by subtracting pi
+    direction = np.where(delta_y > 0, direction - math.pi, direction)
+
+    # Manual angle correction for > 360 degrees
+    direction = np.mod(math.pi - direction, 2 * math.pi)
+
+    # Convert to +/- pi
+    direction = np.where(direction > math.pi, direction - 2 * math.pi, direction)
+
+    return magnitude, direction
+
+
+class snapshot:
+    """
+    Distance and direction from every marker to every other marker, using the conventions of `coords.calculate_vector`.
+    Matrices are only calculated between `active` markers (tracked and not stale), so the cost per frame is set by
+    the markers in view rather than the size of the map; vectors to any other marker are calculated when asked for.
+    Markers which have not been seen are NaN.
+    """
+
+    def __init__(self, positions, timestamp, capture_times, active=None):
+        self.positions = np.asarray(positions, dtype=np.float64)
+
+        # Time the positions were predicted to, and the capture time of the frame each came from
+        self.time = timestamp
+        self.capture_times = np.asarray(capture_times, dtype=np.float64)
+
+        if active is None:
+            active = ~np.isnan(self.positions).any(axis=1)
+
+        # Row and column of each marker in the matrices, or -1 if not active
+        self.ids = np.flatnonzero(active)
+        self.index = np.full(len(self.positions), -1)
+        self.index[self.ids] = np.arange(len(self.ids))
+
+        # Rows are the source marker, columns the target
+        active_positions = self.positions[self.ids]
+
+        self.magnitude, self.direction = vectors(
+            active_positions[:, None], active_positions[None, :])
+
+    def vector(self, source, target):
+        """
+        Returns the distance and direction between two markers, or None if either has not been seen.
+        """
+        row, column = self.index[source], self.index[target]
+
+        if row >= 0 and column >= 0:
+            magnitude, direction = self.magnitude[row, column], self.direction[row, column]
+        else:
+            magnitude, direction = vectors(self.positions[source], self.positions[target])
+
+        if np.isnan(magnitude):
+            return None
+
+        return float(magnitude), float(direction)
+
+    def capture_time(self, source, target):
+        """
+        Returns the capture time of the oldest of two markers.
+        """
+        return float(min(self.capture_times[source], self.capture_times[target]))